@@ -1,8 +1,30 @@
 import os
 import celery
+from django.conf import settings
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'as207960_support.settings')
 
-app = celery.Celery('as207960_support')
+WORKER_PROFILES = {
+    "notifications": {"queues": ["notifications"], "pool": "threads", "concurrency": 16, "prefetch_multiplier": 4},
+    "email": {"queues": ["email"], "pool": "threads", "concurrency": 8, "prefetch_multiplier": 1},
+    # PGP runs inline in prefork children, so concurrency None means one child per PGP pool slot
+    "crypto": {"queues": ["crypto"], "pool": "prefork", "concurrency": None, "prefetch_multiplier": 1},
+    "bulk": {"queues": ["bulk", "celery"], "pool": "threads", "concurrency": 4, "prefetch_multiplier": 1},
+    "all": {
+        "queues": ["notifications", "email", "crypto", "bulk", "celery"], "pool": "threads", "concurrency": 8,
+        "prefetch_multiplier": 1
+    },
+}
+
+
+class SupportTask(celery.Task):
+    def retry(self, *args, **kwargs):
+        if self.request.retries + 1 >= settings.TASK_RETRY_DEMOTE_AFTER:
+            kwargs.setdefault("queue", "bulk")
+            kwargs.setdefault("priority", 0)
+        return super().retry(*args, **kwargs)
+
+
+app = celery.Celery('as207960_support', task_cls=SupportTask)
 app.config_from_object('django.conf:settings', namespace='CELERY')
 app.autodiscover_tasks()
@@ -13,12 +13,28 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 import os
 import sentry_sdk
 from sentry_sdk.integrations.django import DjangoIntegration
+from sentry_sdk.integrations.celery import CeleryIntegration
 import logging
 import stripe
+from kombu import Queue
+from boto3.s3.transfer import TransferConfig
+
+SENTRY_TRACES_SAMPLE_RATE = float(os.getenv("SENTRY_TRACES_SAMPLE_RATE", 0))
+SENTRY_UNTRACED_PATHS = ("/metrics/",)
+
+
+def sentry_traces_sampler(sampling_context):
+    if sampling_context.get("parent_sampled") is not None:
+        return sampling_context["parent_sampled"]
+    if sampling_context.get("wsgi_environ", {}).get("PATH_INFO") in SENTRY_UNTRACED_PATHS:
+        return 0
+    return SENTRY_TRACES_SAMPLE_RATE
+
 
 sentry_sdk.init(
     dsn="https://ebb7321686b94776adccc2d90b87d979@o222429.ingest.sentry.io/5466508",
-    integrations=[DjangoIntegration()],
+    integrations=[DjangoIntegration(), CeleryIntegration()],
+    traces_sampler=sentry_traces_sampler,
     send_default_pii=True
 )
 
@@ -58,6 +74,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'support.middleware.Metrics',
     'xff.middleware.XForwardedForMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -110,11 +127,57 @@ DATABASES = {
         "USER": os.getenv("DB_USER", "support"),
         "PASSWORD": os.getenv("DB_PASS"),
         "PORT": '26257',
+        "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "300")),
+        "CONN_HEALTH_CHECKS": True,
         "OPTIONS": {
             "application_name": os.getenv("APP_NAME", "support")
         }
     }
 }
+DB_TRANSACTION_ATTEMPTS = int(os.getenv("DB_TRANSACTION_ATTEMPTS", "5"))
+
+CACHE_BACKENDS = {
+    "locmem": "support.cache.LocMemCache",
+    "redis": "support.cache.RedisCache",
+}
+cache_backend = os.getenv("CACHE_BACKEND", "locmem")
+fragment_cache_backend = os.getenv("FRAGMENT_CACHE_BACKEND", cache_backend)
+CACHE_BACKEND = CACHE_BACKENDS.get(cache_backend, cache_backend)
+FRAGMENT_CACHE_BACKEND = CACHE_BACKENDS.get(fragment_cache_backend, fragment_cache_backend)
+CACHES = {
+    "default": {
+        "BACKEND": CACHE_BACKEND,
+        "METRICS_NAME": "default",
+        "LOCATION": os.getenv("CACHE_LOCATION", "default"),
+        "KEY_PREFIX": os.getenv("CACHE_KEY_PREFIX", "support"),
+        "TIMEOUT": int(os.getenv("CACHE_TIMEOUT", 300)),
+    },
+    "fragments": {
+        "BACKEND": FRAGMENT_CACHE_BACKEND,
+        "METRICS_NAME": "fragments",
+        "LOCATION": os.getenv("FRAGMENT_CACHE_LOCATION", os.getenv("CACHE_LOCATION", "fragments")),
+        "KEY_PREFIX": os.getenv("CACHE_KEY_PREFIX", "support"),
+        "TIMEOUT": int(os.getenv("FRAGMENT_CACHE_TIMEOUT", 7 * 24 * 3600)),
+    },
+}
+if CACHE_BACKEND == CACHE_BACKENDS["locmem"]:
+    CACHES["default"]["OPTIONS"] = {
+        "MAX_ENTRIES": int(os.getenv("CACHE_MAX_ENTRIES", 10000)),
+    }
+if FRAGMENT_CACHE_BACKEND == CACHE_BACKENDS["locmem"]:
+    CACHES["fragments"]["OPTIONS"] = {
+        "MAX_ENTRIES": int(os.getenv("FRAGMENT_CACHE_MAX_ENTRIES", 5000)),
+    }
+
+SESSION_ENGINES = {
+    "db": "django.contrib.sessions.backends.db",
+    "cached_db": "django.contrib.sessions.backends.cached_db",
+    "signed_cookies": "django.contrib.sessions.backends.signed_cookies",
+}
+# A per-process cache in front of the session table would serve stale sessions across workers
+SESSION_ENGINE = SESSION_ENGINES[
+    os.getenv("SESSION_ENGINE", "db" if CACHE_BACKEND == CACHE_BACKENDS["locmem"] else "cached_db")
+]
 
 
 # Password validation
@@ -168,6 +231,11 @@ AWS_S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID", "")
 AWS_S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY", "")
 AWS_S3_ADDRESSING_STYLE = "virtual"
 AWS_S3_SIGNATURE_VERSION = "s3v4"
+AWS_S3_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=int(os.getenv("S3_MULTIPART_THRESHOLD", 8 * 1024 * 1024)),
+    multipart_chunksize=int(os.getenv("S3_MULTIPART_CHUNKSIZE", 8 * 1024 * 1024)),
+    max_concurrency=int(os.getenv("S3_MULTIPART_CONCURRENCY", 4)),
+)
 
 STORAGES = {
     "default": {"BACKEND": "storages.backends.s3boto3.S3Boto3Storage"},
@@ -189,6 +257,7 @@ XFF_TRUSTED_PROXY_DEPTH = 1
 XFF_NO_SPOOFING = True
 XFF_HEADER_REQUIRED = True
 
+EMAIL_BACKEND = "support.mail.PooledEmailBackend"
 EMAIL_HOST = os.getenv("EMAIL_HOST")
 EMAIL_PORT = int(os.getenv("EMAIL_PORT", 25))
 EMAIL_HOST_USER = os.getenv("EMAIL_HOST_USER")
@@ -196,13 +265,40 @@ EMAIL_HOST_PASSWORD = os.getenv("EMAIL_HOST_PASSWORD")
 EMAIL_USE_TLS = os.getenv("EMAIL_USE_TLS", False)
 EMAIL_USE_SSL = os.getenv("EMAIL_USE_SSL", False)
 DEFAULT_FROM_EMAIL = os.getenv("EMAIL_FROM", "Glauca / AS207960 Support <hello@glauca.digital>")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))
+SMTP_POOL_MAX_IDLE = int(os.getenv("SMTP_POOL_MAX_IDLE", 120))
+SMTP_POOL_HEALTH_CHECK_INTERVAL = int(os.getenv("SMTP_POOL_HEALTH_CHECK_INTERVAL", 15))
 
 CELERY_RESULT_BACKEND = "rpc://"
 CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
 CELERY_TASK_SERIALIZER = "json"
 CELERY_ACCEPT_CONTENT = ["json"]
+CELERY_IMPORTS = ["support.inbound"]
+CELERY_TASK_QUEUES = [
+    Queue(name, routing_key=name, queue_arguments={"x-max-priority": 9})
+    for name in ("notifications", "email", "crypto", "bulk")
+]
+CELERY_TASK_DEFAULT_QUEUE = "email"
+CELERY_TASK_DEFAULT_PRIORITY = 3
+CELERY_TASK_QUEUE_MAX_PRIORITY = 9
+CELERY_TASK_ROUTES = {
+    "support.tasks.send_notification": {"queue": "notifications"},
+    "support.tasks.flush_notifications": {"queue": "notifications"},
+    "support.tasks.send_single_notification": {"queue": "notifications"},
+    "support.tasks.send_pushover_notification": {"queue": "notifications"},
+    "support.inbound.process_inbound_email": {"queue": "crypto"},
+    "support.tasks.send_*": {"queue": "email"},
+}
+TASK_RETRY_DEMOTE_AFTER = int(os.getenv("TASK_RETRY_DEMOTE_AFTER", 3))
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+WORKER_METRICS_PORT = int(os.getenv("WORKER_METRICS_PORT", 0)) or None
 
 POSTAL_PUBLIC_KEY = os.getenv("POSTAL_PUBLIC_KEY")
+POSTAL_WEBHOOK_ASYNC = os.getenv("POSTAL_WEBHOOK_ASYNC", "false").lower() == "true"
+POSTAL_WEBHOOK_MAX_SIZE = int(os.getenv("POSTAL_WEBHOOK_MAX_SIZE", 64 * 1024 * 1024))
+POSTAL_WEBHOOK_SPOOL_MAX_SIZE = int(os.getenv("POSTAL_WEBHOOK_SPOOL_MAX_SIZE", 1024 * 1024))
+INBOUND_EMAIL_RETENTION = int(os.getenv("INBOUND_EMAIL_RETENTION", 30 * 86400))
 
 FEEDBACK_URL = os.getenv("FEEDBACK_URL")
 
@@ -233,14 +329,31 @@ REST_FRAMEWORK = {
 }
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+PAGINATION_COUNT_CACHE_TTL = int(os.getenv("PAGINATION_COUNT_CACHE_TTL", 60))
+TIMELINE_INITIAL_MESSAGES = int(os.getenv("TIMELINE_INITIAL_MESSAGES", 25))
+TIMELINE_PAGE_MESSAGES = int(os.getenv("TIMELINE_PAGE_MESSAGES", 25))
+SEARCH_RESULT_LIMIT = int(os.getenv("SEARCH_RESULT_LIMIT", 50))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+OUTBOX_RETENTION = int(os.getenv("OUTBOX_RETENTION", 86400))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_RETRY_BACKOFF = float(os.getenv("OUTBOX_RETRY_BACKOFF", 1))
+OUTBOX_RETRY_BACKOFF_MAX = float(os.getenv("OUTBOX_RETRY_BACKOFF_MAX", 600))
+ATTACHMENT_UPLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_UPLOAD_CONCURRENCY", 8))
+ATTACHMENT_SPOOL_MAX_SIZE = int(os.getenv("ATTACHMENT_SPOOL_MAX_SIZE", 1024 * 1024))
 
 stripe.api_key = os.getenv("STRIPE_SERVER_KEY")
 STRIPE_ENDPOINT_SECRET = os.getenv("STRIPE_ENDPOINT_SECRET")
 
 PUSHOVER_APP_TOKEN = os.getenv("PUSHOVER_APP_TOKEN")
+NOTIFICATION_COALESCE_WINDOW = int(os.getenv("NOTIFICATION_COALESCE_WINDOW", 30))
 
 PGP_PRIVATE_KEY_FILE = os.getenv("PGP_PRIVATE_KEY_FILE")
 PGP_PRIVATE_KEY_PASSWORD = os.getenv("PGP_PRIVATE_KEY_PASSWORD")
+PGP_KEY_CACHE_SIZE = int(os.getenv("PGP_KEY_CACHE_SIZE", 256))
+PGP_KEY_STATE_CACHE_TTL = int(os.getenv("PGP_KEY_STATE_CACHE_TTL", 300))
+PGP_POOL_SIZE = int(os.getenv("PGP_POOL_SIZE", 2))
+PGP_OPERATION_TIMEOUT = int(os.getenv("PGP_OPERATION_TIMEOUT", 60))
 
 LOGGING = {
     'version': 1,
@@ -14,6 +14,7 @@ import os
 import logging
 import json
 import stripe
+from kombu import Queue
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
@@ -50,6 +51,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'support.middleware.Metrics',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -96,8 +98,30 @@ DATABASES = {
         "NAME": "as207960_support",
         "USER": "postgres",
         "PASSWORD": "",
+        "CONN_MAX_AGE": 60,
+        "CONN_HEALTH_CHECKS": True,
     }
 }
+DB_TRANSACTION_ATTEMPTS = 5
+
+CACHES = {
+    "default": {
+        "BACKEND": "support.cache.LocMemCache",
+        "METRICS_NAME": "default",
+        "LOCATION": "default",
+        "KEY_PREFIX": "support",
+    },
+    "fragments": {
+        "BACKEND": "support.cache.LocMemCache",
+        "METRICS_NAME": "fragments",
+        "LOCATION": "fragments",
+        "KEY_PREFIX": "support",
+        "OPTIONS": {
+            "MAX_ENTRIES": 1000,
+        },
+    },
+}
+SESSION_ENGINE = "django.contrib.sessions.backends.db"
 
 
 # Password validation
@@ -149,6 +173,26 @@ CRISPY_FAIL_SILENTLY = not DEBUG
 EMAIL_BACKEND = "django.core.mail.backends.console.EmailBackend"
 DEFAULT_FROM_EMAIL = "Glauca / AS207960 Support <hello@glauca.digital>"
 
+CELERY_TASK_QUEUES = [
+    Queue(name, routing_key=name, queue_arguments={"x-max-priority": 9})
+    for name in ("notifications", "email", "crypto", "bulk")
+]
+CELERY_TASK_DEFAULT_QUEUE = "email"
+CELERY_TASK_DEFAULT_PRIORITY = 3
+CELERY_TASK_QUEUE_MAX_PRIORITY = 9
+CELERY_TASK_ROUTES = {
+    "support.tasks.send_notification": {"queue": "notifications"},
+    "support.tasks.flush_notifications": {"queue": "notifications"},
+    "support.tasks.send_single_notification": {"queue": "notifications"},
+    "support.tasks.send_pushover_notification": {"queue": "notifications"},
+    "support.inbound.process_inbound_email": {"queue": "crypto"},
+    "support.tasks.send_*": {"queue": "email"},
+}
+TASK_RETRY_DEMOTE_AFTER = 3
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+WORKER_METRICS_PORT = None
+
 with open(os.path.join(BASE_DIR, "secrets/keycloak.json")) as f:
     keycloak_conf = json.load(f)
 with open(os.path.join(BASE_DIR, "secrets/recaptcha.json")) as f:
@@ -164,6 +208,7 @@ stripe.api_key = stripe_conf["server_key"]
 STRIPE_ENDPOINT_SECRET = stripe_conf["endpoint_secret"]
 
 PUSHOVER_APP_TOKEN = pushover_conf["app_token"]
+NOTIFICATION_COALESCE_WINDOW = 0
 
 KEYCLOAK_SERVER_URL = keycloak_conf["server_url"]
 KEYCLOAK_REALM = keycloak_conf["realm"]
@@ -176,12 +221,20 @@ RECAPTCHA_SECRET_KEY = recaptcha_conf["secret_key"]
 
 PGP_PRIVATE_KEY_FILE = pgp_conf["file"]
 PGP_PRIVATE_KEY_PASSWORD = pgp_conf["password"]
+PGP_KEY_CACHE_SIZE = int(os.getenv("PGP_KEY_CACHE_SIZE", 256))
+PGP_KEY_STATE_CACHE_TTL = int(os.getenv("PGP_KEY_STATE_CACHE_TTL", 300))
+PGP_POOL_SIZE = 0
+PGP_OPERATION_TIMEOUT = int(os.getenv("PGP_OPERATION_TIMEOUT", 60))
 
 FEEDBACK_URL = "none"
 
 POSTAL_PUBLIC_KEY = \
     "MIGfMA0GCSqGSIb3DQEBAQUAA4GNADCBiQKBgQChELn1Fkauo6bduyGeXNca/z27OYNMd85JZMlNiycfFHaAXzgPd53OKVSbyzBuILFPYmzkfaF" \
     "uOCW2qgvFd8cAye6qLsUAqEetiuRTPpAysX3hss1TqIML51kb0ADTmylKi3Hr553qrDy9AEMFmvaKnTH8o0YFozGk0QtlmiLtXQIDAQAB"
+POSTAL_WEBHOOK_ASYNC = False
+POSTAL_WEBHOOK_MAX_SIZE = int(os.getenv("POSTAL_WEBHOOK_MAX_SIZE", 64 * 1024 * 1024))
+POSTAL_WEBHOOK_SPOOL_MAX_SIZE = int(os.getenv("POSTAL_WEBHOOK_SPOOL_MAX_SIZE", 1024 * 1024))
+INBOUND_EMAIL_RETENTION = int(os.getenv("INBOUND_EMAIL_RETENTION", 30 * 86400))
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': [
@@ -205,6 +258,18 @@ REST_FRAMEWORK = {
 }
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+PAGINATION_COUNT_CACHE_TTL = int(os.getenv("PAGINATION_COUNT_CACHE_TTL", 60))
+TIMELINE_INITIAL_MESSAGES = int(os.getenv("TIMELINE_INITIAL_MESSAGES", 25))
+TIMELINE_PAGE_MESSAGES = int(os.getenv("TIMELINE_PAGE_MESSAGES", 25))
+SEARCH_RESULT_LIMIT = int(os.getenv("SEARCH_RESULT_LIMIT", 50))
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", 100))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))
+OUTBOX_RETENTION = int(os.getenv("OUTBOX_RETENTION", 86400))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))
+OUTBOX_RETRY_BACKOFF = float(os.getenv("OUTBOX_RETRY_BACKOFF", 1))
+OUTBOX_RETRY_BACKOFF_MAX = float(os.getenv("OUTBOX_RETRY_BACKOFF_MAX", 600))
+ATTACHMENT_UPLOAD_CONCURRENCY = int(os.getenv("ATTACHMENT_UPLOAD_CONCURRENCY", 8))
+ATTACHMENT_SPOOL_MAX_SIZE = int(os.getenv("ATTACHMENT_SPOOL_MAX_SIZE", 1024 * 1024))
 
 LOGGING = {
     'version': 1,
@@ -0,0 +1,26 @@
+import os
+import sys
+from django.conf import settings
+from .celery import WORKER_PROFILES
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in WORKER_PROFILES:
+        sys.exit(f"Usage: python3 -m as207960_support.worker {{{'|'.join(WORKER_PROFILES.keys())}}} [celery args]")
+
+    name = sys.argv[1]
+    profile = WORKER_PROFILES[name]
+    concurrency = profile["concurrency"] or max(settings.PGP_POOL_SIZE, 1)
+    os.execvp("celery", [
+        "celery", "-A", "as207960_support", "worker", "--loglevel=INFO",
+        "-n", f"{name}@%h",
+        "-Q", ",".join(profile["queues"]),
+        "-P", profile["pool"],
+        "-c", str(concurrency),
+        "--prefetch-multiplier", str(profile["prefetch_multiplier"]),
+        *sys.argv[2:]
+    ])
+
+
+if __name__ == "__main__":
+    main()
@@ -4,4 +4,4 @@ from . import models
 
 @admin.register(models.Customer)
 class CustomerAdmin(admin.ModelAdmin):
-    search_fields = ['email']
+    search_fields = ['email', 'full_name']
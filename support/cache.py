@@ -0,0 +1,70 @@
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends import locmem, redis
+import typing
+from . import metrics
+
+
+def cache_key(namespace: str, *parts) -> str:
+    return ":".join([namespace, *(str(p) for p in parts)])
+
+
+class CacheStatsMixin:
+    def __init__(self, server, params):
+        super().__init__(server, params)
+        self.metrics_name = params.get("METRICS_NAME", "default")
+        self.hits = 0
+        self.misses = 0
+        self._counting_many = False
+
+    def _record(self, hits: int, misses: int):
+        self.hits += hits
+        self.misses += misses
+        if hits:
+            metrics.CACHE_REQUESTS.labels(self.metrics_name, "hit").inc(hits)
+        if misses:
+            metrics.CACHE_REQUESTS.labels(self.metrics_name, "miss").inc(misses)
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, self._missing_key, version)
+        if self._counting_many:
+            return default if value is self._missing_key else value
+        if value is self._missing_key:
+            self._record(0, 1)
+            return default
+        self._record(1, 0)
+        return value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        self._counting_many = True
+        try:
+            values = super().get_many(keys, version)
+        finally:
+            self._counting_many = False
+        self._record(len(values), len(keys) - len(values))
+        return values
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else None,
+        }
+
+
+class LocMemCache(CacheStatsMixin, locmem.LocMemCache):
+    pass
+
+
+class RedisCache(CacheStatsMixin, redis.RedisCache):
+    pass
+
+
+def cache_stats() -> typing.Dict[str, dict]:
+    return {
+        alias: caches[alias].stats()
+        for alias in settings.CACHES.keys()
+        if isinstance(caches[alias], CacheStatsMixin)
+    }
@@ -0,0 +1,37 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections, transaction
+import functools
+import random
+import time
+
+RETRYABLE_SQLSTATES = ("40001",)
+
+
+def is_retryable(error: Exception) -> bool:
+    cause = error.__cause__
+    sqlstate = getattr(cause, "pgcode", None) or getattr(cause, "sqlstate", None)
+    return sqlstate in RETRYABLE_SQLSTATES
+
+
+def retry_transaction(func=None, *, using: str = DEFAULT_DB_ALIAS, attempts: int = None):
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            if connections[using].in_atomic_block:
+                return f(*args, **kwargs)
+
+            max_attempts = attempts or settings.DB_TRANSACTION_ATTEMPTS
+            for attempt in range(1, max_attempts + 1):
+                try:
+                    with transaction.atomic(using=using):
+                        return f(*args, **kwargs)
+                except OperationalError as e:
+                    if attempt >= max_attempts or not is_retryable(e):
+                        raise
+                    time.sleep(min(0.01 * (2 ** attempt), 1.0) * random.uniform(0.5, 1.0))
+
+        return wrapper
+
+    if func is not None:
+        return decorator(func)
+    return decorator
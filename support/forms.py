@@ -336,3 +336,36 @@ class PGPKeyForm(forms.Form):
         )
 
         self.helper.add_input(crispy_forms.layout.Submit('submit', 'Upload'))
+
+
+class TicketSearchForm(forms.Form):
+    q = forms.CharField(label="Search", required=True, max_length=255)
+    state = forms.ChoiceField(choices=(("", "Any"),) + models.Ticket.STATES, label="State", required=False)
+    priority = forms.ChoiceField(choices=(("", "Any"),) + models.Ticket.PRIORITIES, label="Priority", required=False)
+    assigned_to = UserModelChoiceField(
+        queryset=django.contrib.auth.models.User.objects.filter(
+            customer__is_agent=True
+        ), label="Assigned to", required=False
+    )
+    date_from = forms.DateField(label="Last message from", required=False)
+    date_to = forms.DateField(label="Last message to", required=False)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.helper = crispy_forms.helper.FormHelper()
+        self.helper.use_custom_control = False
+        self.helper.field_class = 'my-1'
+        self.helper.form_method = 'get'
+        self.helper.layout = crispy_forms.layout.Layout(
+            'q',
+            crispy_forms.layout.Row(
+                crispy_forms.layout.Column('state'),
+                crispy_forms.layout.Column('priority'),
+                crispy_forms.layout.Column('assigned_to'),
+                crispy_forms.layout.Column('date_from'),
+                crispy_forms.layout.Column('date_to'),
+            ),
+        )
+
+        self.helper.add_input(crispy_forms.layout.Submit('submit', 'Search'))
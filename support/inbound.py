@@ -0,0 +1,564 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from celery import shared_task
+import logging
+import datetime
+import email.parser
+import email.feedparser
+import email.policy
+import email.message
+import markdown2
+import io
+import binascii
+import re
+import tempfile
+import bs4
+import concurrent.futures
+import functools
+import hashlib
+import mimetypes
+import pgpy
+import typing
+from . import models, tasks, pgp, metrics
+from .db import retry_transaction
+
+logger = logging.getLogger(__name__)
+
+DECODE_CHUNK_SIZE = 64 * 1024
+BASE64_INVALID = re.compile(rb"[^A-Za-z0-9+/=]")
+
+
+def split_multipart(contents: str, boundary: str) -> typing.List[str]:
+    parts = []
+    current_part = None
+    stream = io.StringIO(contents)
+    while line := stream.readline():
+        line = line.rstrip("\r\n")
+        if line == f"--{boundary}":
+            if current_part is not None:
+                parts.append("\r\n".join(current_part))
+            current_part = []
+        elif line == f"--{boundary}--":
+            if current_part is not None:
+                parts.append("\r\n".join(current_part))
+            break
+        else:
+            if current_part is not None:
+                current_part.append(line)
+    return parts
+
+
+def iter_payload_chunks(payload: str) -> typing.Iterator[bytes]:
+    for i in range(0, len(payload), DECODE_CHUNK_SIZE):
+        chunk = payload[i:i + DECODE_CHUNK_SIZE]
+        try:
+            yield chunk.encode("ascii", "surrogateescape")
+        except UnicodeError:
+            yield chunk.encode("raw-unicode-escape")
+
+
+def decode_base64(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    remainder = b""
+    for chunk in chunks:
+        data = remainder + BASE64_INVALID.sub(b"", chunk)
+        usable = len(data) - len(data) % 4
+        remainder = data[usable:]
+        if usable:
+            yield binascii.a2b_base64(data[:usable])
+
+    remainder = remainder.rstrip(b"=")
+    if len(remainder) % 4 > 1:
+        yield binascii.a2b_base64(remainder + b"=" * (-len(remainder) % 4))
+
+
+def decode_quoted_printable(chunks: typing.Iterable[bytes]) -> typing.Iterator[bytes]:
+    remainder = b""
+    for chunk in chunks:
+        data = remainder + chunk
+        usable = data.rfind(b"\n") + 1
+        remainder = data[usable:]
+        if usable:
+            yield binascii.a2b_qp(data[:usable])
+
+    if remainder:
+        yield binascii.a2b_qp(remainder)
+
+
+def iter_decoded_payload(part: email.message.EmailMessage) -> typing.Iterator[bytes]:
+    payload = part.get_payload()
+    encoding = part.get("content-transfer-encoding", "").strip().lower()
+    if not isinstance(payload, str) or encoding not in ("base64", "quoted-printable"):
+        yield part.get_payload(decode=True) or b""
+    elif encoding == "base64":
+        yield from decode_base64(iter_payload_chunks(payload))
+    else:
+        yield from decode_quoted_printable(iter_payload_chunks(payload))
+
+
+def spool_attachment(part: email.message.EmailMessage) -> typing.Tuple[typing.IO[bytes], str, int]:
+    content = tempfile.SpooledTemporaryFile(max_size=settings.ATTACHMENT_SPOOL_MAX_SIZE)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        for chunk in iter_decoded_payload(part):
+            content.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+    except Exception:
+        content.close()
+        raise
+    content.seek(0)
+    return content, digest.hexdigest(), size
+
+
+def process_email(msg_bytes: bytes):
+    process_email_chunks([msg_bytes])
+
+
+def process_email_chunks(chunks: typing.Iterable[bytes]):
+    parser = email.parser.BytesParser(_class=email.message.EmailMessage, policy=email.policy.SMTPUTF8)
+    with metrics.phase("inbound_email", "mime_parse"):
+        feed_parser = email.feedparser.BytesFeedParser(
+            _factory=email.message.EmailMessage, policy=email.policy.SMTPUTF8
+        )
+        raw_chunks = []
+        for chunk in chunks:
+            feed_parser.feed(chunk)
+            raw_chunks.append(chunk)
+        message = feed_parser.close()
+
+    if 'message-id' not in message:
+        logger.warning("No message ID, throwing away")
+        return
+
+    message_id_claim = models.EmailMessageID.claim(message['message-id'])
+    if not message_id_claim:
+        logger.warning(f"Duplicate message, throwing away: {message['message-id']}")
+        return
+
+    new_message = None
+    try:
+        new_message = process_message(parser, message, b"".join(raw_chunks))
+    finally:
+        if not new_message:
+            models.EmailMessageID.objects.filter(id=message_id_claim.id, message__isnull=True).delete()
+
+
+def process_message(
+        parser: email.parser.BytesParser, message: email.message.EmailMessage, raw: bytes
+) -> typing.Optional[models.TicketMessage]:
+    if 'from' not in message:
+        logger.warning("No from, throwing away")
+        return
+    from_address = message['from'].addresses[0]
+    customer = models.Customer.get_by_email(from_address.addr_spec, from_address.display_name)
+
+    if 'date' not in message:
+        logger.warning("No date, throwing away")
+        return
+
+    if 'auto-submitted' in message:
+        if message['auto-submitted'] in ('auto-generated', 'auto-replied'):
+            logger.warning("Automatically generated message, throwing away")
+            return
+
+    pgp_message = None
+    pgp_signature = None
+    pgp_signers = []
+    customer_pgp_key = None
+    is_pgp_signed = False
+    is_pgp_verified = False
+
+    if message.get_content_type() == "multipart/encrypted":
+        ct_params = message['Content-Type'].params
+
+        if ct_params.get("protocol") != "application/pgp-encrypted":
+            logger.warning(f"Not a PGP encrypted email")
+            tasks.send_email_decryption_failed.delay(str(from_address), message['message-id'])
+            return
+
+        encrypted_parts = list(message.iter_parts())
+        if len(encrypted_parts) != 2:
+            tasks.send_email_decryption_failed.delay(str(from_address), message['message-id'])
+            return
+
+        if encrypted_parts[0].get_content_type() != "application/pgp-encrypted":
+            tasks.send_email_decryption_failed.delay(str(from_address), message['message-id'])
+            return
+
+        control_info = parser.parsebytes(encrypted_parts[0].get_content())
+        if control_info["Version"] != "1":
+            tasks.send_email_decryption_failed.delay(str(from_address), message['message-id'])
+            return
+
+        if encrypted_parts[1].get_content_type() != "application/octet-stream":
+            tasks.send_email_decryption_failed.delay(str(from_address), message['message-id'])
+            return
+
+        pgp_message = encrypted_parts[1].get_content()
+        try:
+            is_pgp_signed = True
+            with metrics.phase("inbound_email", "pgp_decrypt"):
+                unencrypted_bytes, pgp_message, pgp_signers = pgp.decrypt(pgp_message)
+            pgp_signature = None
+        except (ValueError, pgpy.errors.PGPError) as e:
+            logger.warning(f"Could not decrypt PGP message: {e}")
+            tasks.send_email_decryption_failed.delay(str(from_address), message['message-id'])
+            return
+
+        unencrypted_msg = parser.parsebytes(unencrypted_bytes)
+        if unencrypted_msg["Content-Type"].params.get("protected-headers") == "v1":
+            for k, v in message.items():
+                if k not in unencrypted_msg:
+                    unencrypted_msg[k] = v
+        else:
+            for k, v in message.items():
+                if k in unencrypted_msg:
+                    del unencrypted_msg[k]
+                unencrypted_msg[k] = v
+
+        message = unencrypted_msg
+        raw = unencrypted_bytes
+
+    if message.get_content_type() == "multipart/signed":
+        ct_params = message['Content-Type'].params
+        if ct_params.get("protocol") != "application/pgp-signature":
+            logger.warning("Not a PGP-signed message")
+        else:
+            is_pgp_signed = True
+            # the signature covers the part exactly as sent, so split the raw bytes rather than re-serialising
+            signed_parts = [
+                part.encode("ascii", "surrogateescape")
+                for part in split_multipart(raw.decode("ascii", "surrogateescape"), ct_params['boundary'])
+            ]
+
+            if len(signed_parts) != 2:
+                logger.warning("Not a PGP-signed message")
+                is_pgp_verified = False
+            else:
+                pgp_message = signed_parts[0]
+                signed_part = parser.parsebytes(pgp_message)
+
+                signature_part = parser.parsebytes(signed_parts[1])
+                if signature_part.get_content_type() != "application/pgp-signature":
+                    is_pgp_signed = False
+                else:
+                    pgp_signature = signature_part.get_content()
+                    try:
+                        pgp_signers = [str(pgpy.PGPSignature.from_blob(pgp_signature).signer)]
+                    except (ValueError, pgpy.errors.PGPError):
+                        pgp_signature = None
+                        pgp_message = None
+                        is_pgp_verified = False
+                    else:
+                        if signed_part["Content-Type"].params.get("protected-headers") == "v1":
+                            for k, v in message.items():
+                                if k not in signed_part:
+                                    signed_part[k] = v
+                        else:
+                            for k, v in message.items():
+                                if k in signed_part:
+                                    del signed_part[k]
+                                signed_part[k] = v
+
+                        message = signed_part
+
+    found_new_pgp_keys = []
+    for part in message.walk():
+        if part.get_content_type() == "application/pgp-keys":
+            try:
+                found_new_pgp_keys.append(pgp.parse_key(part.get_content()))
+            except (ValueError, pgpy.errors.PGPError):
+                pass
+
+    signing_key = None
+    if pgp_message and pgp_signers:
+        if not customer.has_pgp_keys():
+            for fingerprint, found_key_ids, key in found_new_pgp_keys:
+                if any(signer in found_key_ids for signer in pgp_signers):
+                    signing_key = (fingerprint, 0, key)
+                    break
+        else:
+            for signer in pgp_signers:
+                db_key = models.CustomerPGPKey.objects.filter(customer=customer, key_ids__contains=[signer]).first()
+                if db_key:
+                    signing_key = db_key.key_ref()
+                    break
+
+    if signing_key:
+        with metrics.phase("inbound_email", "pgp_verify"):
+            is_pgp_verified = pgp.verify(signing_key, pgp_message, pgp_signature)
+        if is_pgp_verified:
+            customer_pgp_key = signing_key[0]
+
+    if is_pgp_verified:
+        if not customer.has_pgp_keys():
+            for i, (fingerprint, found_key_ids, key) in enumerate(found_new_pgp_keys):
+                models.CustomerPGPKey.objects.update_or_create(
+                    customer=customer,
+                    fingerprint=fingerprint,
+                    defaults={
+                        "pgp_key": key,
+                        "key_ids": found_key_ids,
+                        "primary": i == 0
+                    }
+                )
+
+    html_body = message.get_body(('html',))
+    if not html_body:
+        plain_body = message.get_body(('plain',))
+        if not plain_body:
+            logger.warning(f"No usable body, throwing away")
+            return
+        else:
+            plain_body = plain_body.get_content()
+            markdown = markdown2.Markdown()
+            html_body = markdown.convert(plain_body)
+    else:
+        html_body = html_body.get_content()
+
+    message_date = message['date']
+    message_date = (
+                       message_date.datetime if message_date.datetime else timezone.now()
+                   ) if message_date else timezone.now()
+
+    references = message['references']
+    in_reply_to = message['in-reply-to']
+    ticket = None
+
+    with metrics.phase("inbound_email", "threading_lookup"):
+        if in_reply_to:
+            ticket = models.EmailMessageID.find_open_ticket([in_reply_to])
+        if not ticket and references:
+            references = list(filter(None, map(lambda r: r.strip(), references.split(" "))))
+            ticket = models.EmailMessageID.find_open_ticket(references)
+
+    if not ticket and customer.emails_blocked:
+        tasks.send_email_blocked.delay(customer.id, message['message-id'])
+        return
+
+    attachments = []
+    for part in message.walk():
+        if not part.is_attachment():
+            continue
+        if part.get_content_type() == "application/pgp-keys":
+            continue
+        file_ext = mimetypes.guess_extension(part.get_content_type())
+        content_id = str(part["content-id"]) if part["content-id"] else None
+        if content_id and content_id.startswith("<") and content_id.endswith(">"):
+            content_id = content_id[1:-1]
+        else:
+            content_id = None
+        with metrics.phase("inbound_email", "attachment_decode"):
+            content, sha256, size = spool_attachment(part)
+        attachments.append({
+            "file_name": part.get_filename(failobj="Untitled"),
+            "file_ext": file_ext,
+            "content_id": content_id,
+            "content": content,
+            "sha256": sha256,
+            "size": size,
+        })
+
+    try:
+        with metrics.phase("inbound_email", "attachment_upload"):
+            uploaded = upload_attachments(attachments)
+    finally:
+        for attachment in attachments:
+            if "content" in attachment:
+                attachment.pop("content").close()
+
+    committed = []
+
+    @retry_transaction
+    def store_message():
+        transaction.on_commit(functools.partial(committed.append, True))
+        blobs = link_attachment_blobs(attachments, uploaded)
+        storage = models.AttachmentBlob.file.field.storage
+        message_html = replace_cid_urls(html_body, {
+            attachment["content_id"]: storage.url(blobs[attachment["sha256"]].file.name)
+            for attachment in attachments if attachment["content_id"]
+        })
+
+        if not ticket:
+            subject = message['subject'] if message['subject'] else "No subject"
+            new_message = tasks.open_ticket(
+                customer, subject, message_html, source=models.Ticket.SOURCE_EMAIL,
+                priority=models.Ticket.PRIORITY_NORMAL, verified=False, email_id=message['message-id'],
+                date=message_date, is_pgp_signed=is_pgp_signed, is_pgp_verified=is_pgp_verified,
+                customer_pgp_key=customer_pgp_key
+            )
+        else:
+            new_message = tasks.post_message(
+                ticket, message_html, email_id=message['message-id'], date=message_date,
+                is_pgp_signed=is_pgp_signed, is_pgp_verified=is_pgp_verified,
+                customer_pgp_key=customer_pgp_key
+            )
+
+        for attachment in attachments:
+            blob = blobs[attachment["sha256"]]
+            message_attachment = models.TicketMessageAttachment(
+                message=new_message,
+                file_name=attachment["file_name"],
+                blob=blob,
+            )
+            message_attachment.file.name = blob.file.name
+            message_attachment.save()
+
+        return new_message
+
+    try:
+        with metrics.phase("inbound_email", "db_write"):
+            return store_message()
+    except Exception:
+        if not committed:
+            delete_attachments([upload["file_name"] for upload in uploaded.values()])
+        raise
+
+
+def replace_cid_urls(html_body: str, cid_map: typing.Dict[str, str]) -> str:
+    soup = bs4.BeautifulSoup(html_body, 'html.parser')
+
+    def replace_url(tag: str, attr: str):
+        for img_tag in soup.find_all(tag):
+            src = img_tag.get(attr)
+            if src and src.startswith("cid:"):
+                cid = src[4:]
+                new_url = cid_map.get(cid)
+                if new_url:
+                    img_tag[attr] = new_url
+
+    replace_url('img', 'src')
+    replace_url('script', 'src')
+    replace_url('link', 'href')
+    replace_url('audio', 'src')
+    replace_url('video', 'src')
+    replace_url('iframe', 'src')
+    replace_url('embed', 'src')
+    replace_url('source', 'src')
+
+    return str(soup)
+
+
+def upload_attachments(attachments: typing.List[dict]) -> typing.Dict[str, dict]:
+    if not attachments:
+        return {}
+
+    storage = models.AttachmentBlob.file.field.storage
+    max_length = models.AttachmentBlob.file.field.max_length
+
+    known = dict(models.AttachmentBlob.objects.filter(
+        sha256__in={attachment["sha256"] for attachment in attachments}
+    ).values_list("sha256", "file"))
+    pending = {}
+    for attachment in attachments:
+        if attachment["sha256"] not in known:
+            pending.setdefault(attachment["sha256"], attachment)
+
+    def upload(attachment: dict) -> str:
+        file_name = models.AttachmentBlob.file_name(attachment["sha256"], attachment["file_ext"])
+        content = attachment["content"]
+        content.seek(0)
+        return storage.save(file_name, content, max_length=max_length)
+
+    futures = {}
+    if pending:
+        workers = min(len(pending), settings.ATTACHMENT_UPLOAD_CONCURRENCY)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {sha256: executor.submit(upload, attachment) for sha256, attachment in pending.items()}
+            concurrent.futures.wait(futures.values())
+
+    errors = []
+    uploaded = {}
+    for sha256, future in futures.items():
+        if future.exception():
+            errors.append(future.exception())
+        else:
+            uploaded[sha256] = {"file_name": future.result(), "size": pending[sha256]["size"]}
+
+    if errors:
+        delete_attachments([upload["file_name"] for upload in uploaded.values()])
+        raise ExceptionGroup(f"Failed to upload {len(errors)} of {len(pending)} attachments", errors)
+
+    for attachment in attachments:
+        attachment.pop("content").close()
+
+    return uploaded
+
+
+def link_attachment_blobs(
+        attachments: typing.List[dict], uploaded: typing.Dict[str, dict]
+) -> typing.Dict[str, models.AttachmentBlob]:
+    hashes = {attachment["sha256"] for attachment in attachments}
+    blobs = {
+        blob.sha256: blob for blob in
+        models.AttachmentBlob.objects.select_for_update().filter(sha256__in=hashes)
+    }
+
+    for sha256, upload in uploaded.items():
+        if sha256 not in blobs:
+            blobs[sha256], created = models.AttachmentBlob.objects.get_or_create(
+                sha256=sha256, defaults={"file": upload["file_name"], "size": upload["size"]}
+            )
+            if created:
+                continue
+        transaction.on_commit(functools.partial(delete_attachments, [upload["file_name"]]))
+
+    missing = hashes - blobs.keys()
+    if missing:
+        raise models.AttachmentBlob.DoesNotExist(f"Attachment blobs removed during ingestion: {', '.join(missing)}")
+    return blobs
+
+
+def delete_attachments(file_names: typing.List[str]):
+    storage = models.AttachmentBlob.file.field.storage
+    for file_name in file_names:
+        try:
+            storage.delete(file_name)
+        except Exception:
+            logger.exception(f"Failed to clean up attachment {file_name}")
+
+
+def purge_processed_inbound_emails() -> int:
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.INBOUND_EMAIL_RETENTION)
+    inbound_emails = models.InboundEmail.objects.filter(
+        state=models.InboundEmail.STATE_PROCESSED, processed__lt=cutoff
+    ).only("id", "message_file")
+
+    count = 0
+    for inbound_email in inbound_emails.iterator():
+        if inbound_email.message_file:
+            try:
+                inbound_email.message_file.delete(save=False)
+            except Exception:
+                logger.exception(f"Failed to delete stored message for inbound email {inbound_email.id}")
+                continue
+        inbound_email.delete()
+        count += 1
+    return count
+
+
+@shared_task(
+    bind=True, autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=600, max_retries=10,
+    default_retry_delay=3
+)
+def process_inbound_email(self, inbound_email_id):
+    inbound_email = models.InboundEmail.objects.filter(
+        id=inbound_email_id, state=models.InboundEmail.STATE_PENDING
+    ).first()
+    if not inbound_email:
+        return
+
+    try:
+        process_email_chunks(inbound_email.message_chunks())
+    except Exception:
+        if self.request.retries >= self.max_retries:
+            logger.exception(f"Giving up on inbound email {inbound_email.id}")
+            inbound_email.state = models.InboundEmail.STATE_FAILED
+            inbound_email.save(update_fields=["state"])
+        raise
+
+    inbound_email.state = models.InboundEmail.STATE_PROCESSED
+    inbound_email.processed = timezone.now()
+    inbound_email.save(update_fields=["state", "processed"])
@@ -0,0 +1,168 @@
+from django.conf import settings
+from django.core.mail.backends.smtp import EmailBackend
+import celery.signals
+import atexit
+import os
+import smtplib
+import threading
+import time
+import logging
+import sentry_sdk
+
+logger = logging.getLogger(__name__)
+
+
+class SMTPConnectionPool:
+    def __init__(self, max_size: int, max_idle: float):
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._connections = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._connections = {}
+            self._pid = os.getpid()
+
+    def acquire(self, key):
+        with self._lock:
+            self._check_pid()
+            connections = self._connections.get(key)
+            while connections:
+                connection, last_used = connections.pop()
+                if time.monotonic() - last_used > self.max_idle:
+                    close_connection(connection)
+                    continue
+                return connection, last_used
+        return None
+
+    def release(self, key, connection):
+        with self._lock:
+            self._check_pid()
+            connections = self._connections.setdefault(key, [])
+            if len(connections) >= self.max_size:
+                close_connection(connection)
+            else:
+                connections.append((connection, time.monotonic()))
+
+    def clear(self):
+        with self._lock:
+            self._check_pid()
+            for connections in self._connections.values():
+                for connection, _ in connections:
+                    close_connection(connection)
+            self._connections = {}
+
+
+def close_connection(connection):
+    try:
+        connection.quit()
+    except (smtplib.SMTPException, OSError):
+        connection.close()
+
+
+pool = SMTPConnectionPool(settings.SMTP_POOL_SIZE, settings.SMTP_POOL_MAX_IDLE)
+atexit.register(pool.clear)
+
+
+@celery.signals.worker_process_shutdown.connect
+def close_smtp_connections(**_kwargs):
+    pool.clear()
+
+
+class PooledEmailBackend(EmailBackend):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._reused = False
+        self._failed = False
+
+    @property
+    def pool_key(self):
+        return self.host, self.port, self.username, self.use_tls, self.use_ssl
+
+    def open(self):
+        if self.connection:
+            return False
+
+        while pooled := pool.acquire(self.pool_key):
+            connection, last_used = pooled
+            if time.monotonic() - last_used > settings.SMTP_POOL_HEALTH_CHECK_INTERVAL:
+                try:
+                    healthy = connection.noop()[0] == 250
+                except (smtplib.SMTPException, OSError):
+                    healthy = False
+                if not healthy:
+                    close_connection(connection)
+                    continue
+            self.connection = connection
+            self._reused = True
+            self._failed = False
+            return True
+
+        self._reused = False
+        self._failed = False
+        return super().open()
+
+    def close(self):
+        if self.connection is None:
+            return
+        if self._failed:
+            super().close()
+        else:
+            pool.release(self.pool_key, self.connection)
+            self.connection = None
+
+    def _send(self, email_message):
+        with sentry_sdk.start_span(op="smtp", name="send"):
+            return super()._send(email_message)
+
+    def _reconnect(self) -> bool:
+        self._failed = True
+        super().close()
+        self._reused = False
+        self._failed = False
+        return bool(super().open())
+
+    def _connection_dropped(self) -> bool:
+        return self.connection is None or getattr(self.connection, "sock", None) is None
+
+    def _send_pooled(self, email_message):
+        try:
+            sent = self._send(email_message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            if not self._reused:
+                raise
+        else:
+            # with fail_silently the base backend swallows disconnects, so check the socket instead
+            if sent or not self._reused or not self._connection_dropped():
+                return sent
+
+        logger.info("Pooled SMTP connection dropped, reconnecting")
+        if not self._reconnect():
+            return False
+        return self._send(email_message)
+
+    def send_messages(self, email_messages):
+        if not email_messages:
+            return 0
+        with self._lock:
+            new_conn_created = self.open()
+            if not self.connection or new_conn_created is None:
+                return 0
+            num_sent = 0
+            try:
+                for message in email_messages:
+                    if self._send_pooled(message):
+                        num_sent += 1
+                    else:
+                        self._failed = True
+                    if not self.connection:
+                        break
+            except Exception:
+                self._failed = True
+                raise
+            finally:
+                if new_conn_created:
+                    self.close()
+            return num_sent
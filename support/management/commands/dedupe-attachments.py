@@ -0,0 +1,97 @@
+import hashlib
+import logging
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Q
+from ... import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Move attachments stored before content addressing onto shared attachment blobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument(
+            "--delete-legacy-files", action="store_true",
+            help="Point inline images in the owning message at the shared blob and delete duplicate files "
+                 "that no message HTML still links to"
+        )
+
+    def handle(self, *args, **options):
+        legacy_attachments = models.TicketMessageAttachment.objects.filter(blob__isnull=True).order_by('id')
+
+        count = 0
+        deduplicated = 0
+        last_id = None
+        while True:
+            batch = legacy_attachments
+            if last_id:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:options["batch_size"]])
+            if not batch:
+                break
+
+            for attachment in batch:
+                try:
+                    sha256, size = self.hash_file(attachment.file)
+                except OSError as e:
+                    self.stderr.write(f"Could not read attachment {attachment.id}: {e}")
+                    continue
+                if self.link_blob(attachment, sha256, size, options["delete_legacy_files"]):
+                    deduplicated += 1
+
+            last_id = batch[-1].id
+            count += len(batch)
+            self.stdout.write(f"Processed {count} attachments")
+
+        self.stdout.write(f"Done, processed {count} attachments, {deduplicated} were duplicates")
+
+    @staticmethod
+    def hash_file(file):
+        digest = hashlib.sha256()
+        size = 0
+        with file.open("rb") as f:
+            for chunk in f.chunks():
+                digest.update(chunk)
+                size += len(chunk)
+        return digest.hexdigest(), size
+
+    @staticmethod
+    @transaction.atomic
+    def link_blob(attachment: models.TicketMessageAttachment, sha256: str, size: int, delete_legacy: bool) -> bool:
+        blob = models.AttachmentBlob.objects.select_for_update().filter(sha256=sha256).first()
+        duplicate = blob is not None
+        if not duplicate:
+            blob = models.AttachmentBlob.objects.create(sha256=sha256, file=attachment.file.name, size=size)
+
+        models.AttachmentBlob.objects.filter(id=blob.id).update(ref_count=F('ref_count') + 1)
+        models.TicketMessageAttachment.objects.filter(id=attachment.id).update(blob=blob, file=blob.file.name)
+        models.invalidate_message_cards([attachment.message_id])
+
+        # inbound mail has always written permanent storage URLs for cid: images into the message HTML, so a
+        # legacy file can only go once nothing links to it any more
+        if delete_legacy and duplicate and attachment.file.name != blob.file.name:
+            storage = attachment.file.storage
+            old_name = attachment.file.name
+            old_url = storage.url(old_name)
+
+            message = models.TicketMessage.objects.select_for_update().get(id=attachment.message_id)
+            if old_url in message.message:
+                message.message = message.message.replace(old_url, storage.url(blob.file.name))
+                message.message_safe_version = None
+                message.save()
+
+            if not models.TicketMessage.objects.filter(
+                    Q(message__contains=old_url) | Q(message_safe_html__contains=old_url)
+            ).exists():
+                transaction.on_commit(lambda: delete_legacy_file(storage, old_name))
+        return duplicate
+
+
+def delete_legacy_file(storage, name: str):
+    try:
+        storage.delete(name)
+    except Exception:
+        logger.exception(f"Failed to delete legacy attachment {name}")
@@ -0,0 +1,32 @@
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from as207960_support.celery import app
+from ... import outbox
+
+
+class Command(BaseCommand):
+    help = "Dispatch queued outbox messages to Celery"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Drain the outbox once and exit")
+        parser.add_argument("--batch-size", type=int, default=settings.OUTBOX_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        app.loader.import_default_modules()
+        batch_size = options["batch_size"]
+        last_purge = 0
+
+        while True:
+            close_old_connections()
+            if outbox.dispatch_pending(batch_size) >= batch_size:
+                continue
+
+            if time.monotonic() - last_purge > 3600:
+                outbox.purge_dispatched()
+                last_purge = time.monotonic()
+
+            if options["once"]:
+                return
+            time.sleep(settings.OUTBOX_POLL_INTERVAL)
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand
+from django.contrib.postgres.search import SearchVector
+from django.db.models import Q
+from ... import models
+
+
+class Command(BaseCommand):
+    help = "Build the search text and search vectors for ticket messages that have not been indexed yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        unindexed = Q(search_text__isnull=True)
+        if models.has_full_text_search():
+            unindexed |= Q(search_vector__isnull=True)
+        stale_messages = models.TicketMessage.objects.filter(unindexed).order_by('id') \
+            .only('id', 'message', 'message_safe_html', 'message_safe_version', 'search_text')
+
+        count = 0
+        last_id = None
+        while True:
+            batch = stale_messages
+            if last_id:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:options["batch_size"]])
+            if not batch:
+                break
+
+            for message in batch:
+                if message.message_safe_version != models.HTML_SANITIZER_VERSION:
+                    message.update_message_safe()
+                else:
+                    message.search_text = models.html_to_text(message.message_safe_html)
+            models.TicketMessage.objects.bulk_update(
+                batch, ['message_safe_html', 'message_safe_version', 'search_text']
+            )
+            if models.has_full_text_search():
+                models.TicketMessage.objects.filter(id__in=[m.id for m in batch]).update(
+                    search_vector=SearchVector('search_text', config=models.SEARCH_CONFIG)
+                )
+
+            last_id = batch[-1].id
+            count += len(batch)
+            self.stdout.write(f"Indexed {count} messages")
+
+        self.stdout.write(f"Done, indexed {count} messages")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ... import inbound
+
+
+class Command(BaseCommand):
+    help = "Delete processed inbound emails and their stored messages once they pass the retention period"
+
+    def handle(self, *args, **options):
+        count = inbound.purge_processed_inbound_emails()
+        self.stdout.write(f"Purged {count} inbound emails")
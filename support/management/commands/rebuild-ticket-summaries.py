@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count, Min, Max, OuterRef, Subquery
+from ... import models
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalised message summary fields on tickets"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--missing", action="store_true", help="Only rebuild tickets that have never had a summary recorded"
+        )
+
+    def handle(self, *args, **options):
+        last_message = models.TicketMessage.objects.filter(ticket=OuterRef('pk')).order_by('-date', '-id')
+        tickets = models.Ticket.objects.annotate(
+            summary_message_count=Count('messages'),
+            summary_first_message_date=Min('messages__date'),
+            summary_last_message_date=Max('messages__date'),
+            summary_last_message_type=Subquery(last_message.values('type')[:1]),
+        ).order_by('id').only('id', *models.Ticket.SUMMARY_FIELDS)
+        if options["missing"]:
+            tickets = tickets.filter(last_message_date__isnull=True)
+
+        count = 0
+        last_id = None
+        while True:
+            batch = tickets
+            if last_id:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:options["batch_size"]])
+            if not batch:
+                break
+
+            for ticket in batch:
+                ticket.message_count = ticket.summary_message_count
+                ticket.first_message_date = ticket.summary_first_message_date
+                ticket.last_message_date = ticket.summary_last_message_date
+                ticket.last_message_type = ticket.summary_last_message_type
+                ticket.awaiting_agent = ticket.last_message_type in models.TicketMessage.AWAITING_AGENT_TYPES
+            models.Ticket.objects.bulk_update(batch, models.Ticket.SUMMARY_FIELDS)
+
+            last_id = batch[-1].id
+            count += len(batch)
+            self.stdout.write(f"Rebuilt {count} ticket summaries")
+
+        self.stdout.write(f"Done, rebuilt {count} ticket summaries")
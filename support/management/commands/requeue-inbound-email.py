@@ -0,0 +1,28 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from ... import models, inbound
+
+
+class Command(BaseCommand):
+    help = "Requeue inbound emails that were stored but never processed"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--min-age", type=int, default=15, help="Minimum age in minutes of emails to requeue")
+        parser.add_argument("--failed", action="store_true", help="Also retry emails that previously failed")
+
+    def handle(self, *args, **options):
+        states = [models.InboundEmail.STATE_PENDING]
+        if options["failed"]:
+            states.append(models.InboundEmail.STATE_FAILED)
+
+        cutoff = timezone.now() - datetime.timedelta(minutes=options["min_age"])
+        inbound_emails = models.InboundEmail.objects.filter(state__in=states, received__lte=cutoff)
+
+        count = 0
+        for inbound_email_id in inbound_emails.values_list("id", flat=True).iterator():
+            models.InboundEmail.objects.filter(id=inbound_email_id).update(state=models.InboundEmail.STATE_PENDING)
+            inbound.process_inbound_email.apply_async((inbound_email_id,), queue="bulk", priority=0)
+            count += 1
+
+        self.stdout.write(f"Requeued {count} inbound emails")
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+from ... import outbox
+
+
+class Command(BaseCommand):
+    help = "Requeue outbox messages that were dead-lettered after repeated dispatch failures"
+
+    def handle(self, *args, **options):
+        count = outbox.requeue_dead_letters()
+        self.stdout.write(f"Requeued {count} outbox messages")
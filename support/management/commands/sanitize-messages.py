@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+from ... import models
+
+
+class Command(BaseCommand):
+    help = "Store sanitized HTML for ticket messages sanitized with an older (or no) sanitizer version"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, *args, **options):
+        stale_messages = models.TicketMessage.objects.filter(
+            Q(message_safe_version__isnull=True) | Q(message_safe_version__lt=models.HTML_SANITIZER_VERSION)
+        ).order_by('id').only('id', 'message')
+
+        count = 0
+        last_id = None
+        while True:
+            batch = stale_messages
+            if last_id:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch[:options["batch_size"]])
+            if not batch:
+                break
+
+            for message in batch:
+                message.update_message_safe()
+            models.TicketMessage.objects.bulk_update(batch, ['message_safe_html', 'message_safe_version', 'search_text'])
+
+            last_id = batch[-1].id
+            count += len(batch)
+            self.stdout.write(f"Sanitized {count} messages")
+
+        self.stdout.write(f"Done, sanitized {count} messages")
@@ -0,0 +1,126 @@
+from django.conf import settings
+import celery.signals
+import contextlib
+import os
+import threading
+import time
+import prometheus_client
+import prometheus_client.multiprocess
+import sentry_sdk
+
+if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+HTTP_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS", "TRACE", "CONNECT"))
+
+REQUEST_LATENCY = prometheus_client.Histogram(
+    "support_http_request_duration_seconds", "HTTP request latency", ["view", "method", "status"],
+    buckets=LATENCY_BUCKETS
+)
+REQUEST_DB_QUERIES = prometheus_client.Histogram(
+    "support_http_request_db_queries", "Database queries per HTTP request", ["view"],
+    buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+REQUEST_DB_TIME = prometheus_client.Histogram(
+    "support_http_request_db_duration_seconds", "Database time per HTTP request", ["view"],
+    buckets=LATENCY_BUCKETS
+)
+TASK_LATENCY = prometheus_client.Histogram(
+    "support_celery_task_duration_seconds", "Celery task run time", ["task", "state"],
+    buckets=LATENCY_BUCKETS
+)
+TASK_RETRIES = prometheus_client.Counter("support_celery_task_retries", "Celery task retries", ["task"])
+TASK_FAILURES = prometheus_client.Counter("support_celery_task_failures", "Celery task failures", ["task"])
+CACHE_REQUESTS = prometheus_client.Counter("support_cache_requests", "Cache lookups by result", ["cache", "result"])
+PHASE_LATENCY = prometheus_client.Histogram(
+    "support_phase_duration_seconds", "Time spent in each phase of an operation", ["operation", "phase"],
+    buckets=LATENCY_BUCKETS
+)
+
+PGP_OPERATION_LATENCY = prometheus_client.Histogram(
+    "support_pgp_operation_duration_seconds", "PGP operation time including waiting for a worker",
+    ["operation", "result"], buckets=LATENCY_BUCKETS
+)
+PGP_QUEUE_WAIT = prometheus_client.Histogram(
+    "support_pgp_queue_wait_seconds", "Time spent waiting for a free PGP worker", buckets=LATENCY_BUCKETS
+)
+PGP_QUEUE_DEPTH = prometheus_client.Gauge(
+    "support_pgp_queue_depth", "PGP operations waiting for a free worker", multiprocess_mode="livesum"
+)
+PGP_IN_PROGRESS = prometheus_client.Gauge(
+    "support_pgp_operations_in_progress", "PGP operations queued or running", multiprocess_mode="livesum"
+)
+
+
+@contextlib.contextmanager
+def phase(operation: str, name: str):
+    start = time.perf_counter()
+    try:
+        with sentry_sdk.start_span(op=operation, name=name):
+            yield
+    finally:
+        PHASE_LATENCY.labels(operation, name).observe(time.perf_counter() - start)
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.duration += time.perf_counter() - start
+
+
+def observe_request(view: str, method: str, status: int, duration: float, queries: QueryStats):
+    # clients choose the method, so anything non-standard shares one label value
+    REQUEST_LATENCY.labels(view, method if method in HTTP_METHODS else "other", status).observe(duration)
+    REQUEST_DB_QUERIES.labels(view).observe(queries.count)
+    REQUEST_DB_TIME.labels(view).observe(queries.duration)
+
+
+def registry() -> prometheus_client.CollectorRegistry:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        collector_registry = prometheus_client.CollectorRegistry()
+        prometheus_client.multiprocess.MultiProcessCollector(collector_registry)
+        return collector_registry
+    return prometheus_client.REGISTRY
+
+
+_task_starts = {}
+_task_starts_lock = threading.Lock()
+
+
+@celery.signals.task_prerun.connect
+def task_started(task_id, **_kwargs):
+    with _task_starts_lock:
+        _task_starts[task_id] = time.perf_counter()
+
+
+@celery.signals.task_postrun.connect
+def task_finished(task_id, task, state=None, **_kwargs):
+    with _task_starts_lock:
+        start = _task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_LATENCY.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - start)
+
+
+@celery.signals.task_retry.connect
+def task_retried(sender, **_kwargs):
+    TASK_RETRIES.labels(sender.name).inc()
+
+
+@celery.signals.task_failure.connect
+def task_failed(sender, **_kwargs):
+    TASK_FAILURES.labels(sender.name).inc()
+
+
+@celery.signals.worker_init.connect
+def start_worker_metrics_server(**_kwargs):
+    if settings.WORKER_METRICS_PORT:
+        prometheus_client.start_http_server(settings.WORKER_METRICS_PORT, registry=registry())
@@ -1,7 +1,10 @@
 import django.shortcuts
 import django.urls
+import time
 from django.contrib.auth.signals import user_logged_out
+from django.db import connection
 from django.dispatch import receiver
+from . import metrics
 
 
 @receiver(user_logged_out)
@@ -28,6 +31,22 @@ class TryLogin:
             )
 
 
+class Metrics:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = metrics.QueryStats()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - start
+
+        view = request.resolver_match.view_name if request.resolver_match else "unresolved"
+        metrics.observe_request(view, request.method, response.status_code, duration, queries)
+        return response
+
+
 def try_login_exempt(view):
     view.try_login_exempt = True
     return view
@@ -0,0 +1,27 @@
+import as207960_utils.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0010_ticketmessage_pgp_signature_verified_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboundEmail',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='support_inboundemail', primary_key=True, serialize=False)),
+                ('received', models.DateTimeField(auto_now_add=True)),
+                ('mail_from', models.TextField(blank=True, null=True)),
+                ('rcpt_to', models.TextField(blank=True, null=True)),
+                ('message', models.BinaryField()),
+                ('state', models.CharField(choices=[('P', 'Pending'), ('D', 'Processed'), ('F', 'Failed')], db_index=True, default='P', max_length=1)),
+                ('processed', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['received'],
+            },
+        ),
+    ]
@@ -0,0 +1,49 @@
+import as207960_utils.models
+import django.db.models.deletion
+import hashlib
+from django.db import migrations, models
+
+
+def index_message_ids(apps, schema_editor):
+    TicketMessage = apps.get_model('support', 'TicketMessage')
+    EmailMessageID = apps.get_model('support', 'EmailMessageID')
+
+    batch = []
+    messages = TicketMessage.objects.filter(email_message_id__isnull=False)\
+        .values_list('id', 'ticket_id', 'email_message_id')
+    for message_id, ticket_id, email_message_id in messages.iterator():
+        email_message_id = email_message_id.strip()
+        if not email_message_id:
+            continue
+        batch.append(EmailMessageID(
+            message_id_hash=hashlib.sha256(email_message_id.encode()).hexdigest(),
+            email_message_id=email_message_id,
+            message_id=message_id,
+            ticket_id=ticket_id,
+        ))
+        if len(batch) >= 1000:
+            EmailMessageID.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    if batch:
+        EmailMessageID.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0011_inboundemail'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmailMessageID',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='support_emailmessageid', primary_key=True, serialize=False)),
+                ('message_id_hash', models.CharField(max_length=64, unique=True)),
+                ('email_message_id', models.TextField()),
+                ('message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='email_message_ids', to='support.ticketmessage')),
+                ('ticket', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='email_message_ids', to='support.ticket')),
+            ],
+        ),
+        migrations.RunPython(index_message_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0012_emailmessageid'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketmessage',
+            name='message_safe_html',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticketmessage',
+            name='message_safe_version',
+            field=models.PositiveSmallIntegerField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0013_ticketmessage_message_safe'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerpgpkey',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,37 @@
+import django.contrib.postgres.fields
+import django.contrib.postgres.indexes
+import pgpy
+from django.db import migrations, models
+
+
+def extract_key_ids(apps, schema_editor):
+    CustomerPGPKey = apps.get_model('support', 'CustomerPGPKey')
+
+    for db_key in CustomerPGPKey.objects.all().iterator():
+        try:
+            key, _ = pgpy.PGPKey.from_blob(db_key.pgp_key)
+        except (ValueError, pgpy.errors.PGPError):
+            continue
+        db_key.key_ids = [str(key.fingerprint.keyid)] + [str(k) for k in key.subkeys.keys()]
+        db_key.save(update_fields=['key_ids'])
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('support', '0014_customerpgpkey_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerpgpkey',
+            name='key_ids',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.CharField(max_length=16), blank=True, default=list, size=None),
+        ),
+        migrations.RunPython(extract_key_ids, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='customerpgpkey',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['key_ids'], name='support_cus_key_ids_3f6bee_gin'),
+        ),
+    ]
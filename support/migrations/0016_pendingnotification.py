@@ -0,0 +1,24 @@
+import as207960_utils.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0015_customerpgpkey_key_ids'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingNotification',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='support_pendingnotification', primary_key=True, serialize=False)),
+                ('title', models.TextField()),
+                ('message', models.TextField()),
+                ('timestamp', models.PositiveBigIntegerField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('ticket', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='pending_notifications', to='support.ticket')),
+            ],
+        ),
+    ]
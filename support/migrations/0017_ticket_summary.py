@@ -0,0 +1,56 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:48
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0016_pendingnotification'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticket',
+            name='awaiting_agent',
+            field=models.BooleanField(blank=True, default=False),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='first_message_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='last_message_date',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='last_message_type',
+            field=models.CharField(blank=True, max_length=1, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticket',
+            name='message_count',
+            field=models.PositiveIntegerField(blank=True, default=0),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['state', 'deleted', 'awaiting_agent', '-last_message_date', '-id'], name='support_tic_state_ab3182_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['state', 'deleted', '-last_message_date', '-id'], name='support_tic_state_566496_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['assigned_to', 'deleted', '-last_message_date', '-id'], name='support_tic_assigne_dfcbca_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=models.Index(fields=['customer', '-last_message_date', '-id'], name='support_tic_custome_fbb89c_idx'),
+        ),
+    ]
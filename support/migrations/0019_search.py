@@ -0,0 +1,48 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:55
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+
+def create_trigram_extension(apps, schema_editor):
+    # CockroachDB has trigram indexes built in, plain PostgreSQL needs the extension
+    if schema_editor.connection.vendor == "postgresql" and schema_editor.connection.display_name != "CockroachDB":
+        schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0017_ticket_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_trigram_extension, migrations.RunPython.noop),
+        migrations.AddField(
+            model_name='ticketmessage',
+            name='search_text',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='ticketmessage',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['email'], name='support_customer_email_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['full_name'], name='support_customer_name_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='ticket',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['subject'], name='support_ticket_subject_trgm', opclasses=['gin_trgm_ops']),
+        ),
+        migrations.AddIndex(
+            model_name='ticketmessage',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_vector'], name='support_tic_search__f6dd1d_gin'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:00
+
+import as207960_utils.models
+import django.core.serializers.json
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0019_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', as207960_utils.models.TypedUUIDField(data_type='support_outboxmessage', primary_key=True, serialize=False)),
+                ('task', models.CharField(max_length=255)),
+                ('args', models.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('dedup_key', models.CharField(blank=True, max_length=255, null=True, unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('dispatched', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['created'],
+                'indexes': [models.Index(fields=['dispatched', 'created'], name='support_out_dispatc_9dc37a_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0023_attachment_blobs'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='pgp_keys_updated',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
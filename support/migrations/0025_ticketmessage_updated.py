@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:20
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0024_customer_pgp_keys_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ticketmessage',
+            name='updated',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
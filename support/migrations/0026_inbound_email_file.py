@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0025_ticketmessage_updated'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='inboundemail',
+            name='message_file',
+            field=models.FileField(blank=True, null=True, upload_to=''),
+        ),
+        migrations.AlterField(
+            model_name='inboundemail',
+            name='message',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
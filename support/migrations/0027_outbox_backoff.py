@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:26
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('support', '0026_inbound_email_file'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='dead_lettered',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='outboxmessage',
+            name='next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddIndex(
+            model_name='outboxmessage',
+            index=models.Index(fields=['dispatched', 'dead_lettered', 'next_attempt_at'], name='support_out_dispatc_81683b_idx'),
+        ),
+    ]
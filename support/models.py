@@ -1,14 +1,26 @@
 import secrets
+import hashlib
+import uuid
 import as207960_utils.models
 import django.core.exceptions
 import pgpy
+import typing
 from django.conf import settings
-from django.db import models
-from django.db.models.signals import post_save
+from django.db import models, transaction, connection, IntegrityError
+from django.db.models import Case, F, Q, Value, When
+from django.contrib.postgres.fields import ArrayField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db.models.signals import post_save, post_delete, pre_delete
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.signals import user_logged_in
 from django.dispatch import receiver
+from django.utils import timezone
 from phonenumber_field.modelfields import PhoneNumberField
 import lxml.html.clean
+from . import pgp
+from . import cache as support_cache
 
 
 class Customer(models.Model):
@@ -20,6 +32,13 @@ class Customer(models.Model):
     phone_ext = models.CharField(max_length=64, blank=True, null=True, verbose_name="Phone extension")
     pushover_user_key = models.CharField(max_length=255, blank=True, null=True)
     emails_blocked = models.BooleanField(blank=True, null=False, default=False)
+    pgp_keys_updated = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['email'], opclasses=['gin_trgm_ops'], name='support_customer_email_trgm'),
+            GinIndex(fields=['full_name'], opclasses=['gin_trgm_ops'], name='support_customer_name_trgm'),
+        ]
 
     def __str__(self):
         return f"{self.full_name} - {self.email}"
@@ -28,8 +47,33 @@ class Customer(models.Model):
         if self.user:
             self.full_name = f"{self.user.first_name} {self.user.last_name}"
             self.email = self.user.email
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields if not f.primary_key and f.name != "pgp_keys_updated"
+            ]
         super().save(*args, **kwargs)
 
+    def pgp_key_state(self):
+        cache_key = support_cache.cache_key("pgp_key_state", self.id, self.pgp_keys_updated.timestamp())
+        state = cache.get(cache_key)
+        if state is None:
+            state = {
+                "has_keys": self.pgp_keys.exists(),
+                "primary": self.pgp_keys.filter(primary=True).first(),
+            }
+            cache.set(cache_key, state, settings.PGP_KEY_STATE_CACHE_TTL)
+        return state
+
+    def invalidate_pgp_key_state(self):
+        self.pgp_keys_updated = timezone.now()
+        Customer.objects.filter(id=self.id).update(pgp_keys_updated=self.pgp_keys_updated)
+
+    def has_pgp_keys(self) -> bool:
+        return self.pgp_key_state()["has_keys"]
+
+    def primary_pgp_key(self) -> typing.Optional["CustomerPGPKey"]:
+        return self.pgp_key_state()["primary"]
+
     @classmethod
     def get_by_email(cls, email, name=None):
         customer = Customer.objects.filter(email=email).first()
@@ -47,14 +91,42 @@ class CustomerPGPKey(models.Model):
     id = as207960_utils.models.TypedUUIDField("support_pgpkey", primary_key=True)
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE, related_name="pgp_keys")
     fingerprint = models.CharField(max_length=255, db_index=True)
+    key_ids = ArrayField(models.CharField(max_length=16), default=list, blank=True)
     pgp_key = models.TextField()
     primary = models.BooleanField(default=False, null=False, blank=True)
+    version = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        indexes = [
+            GinIndex(fields=['key_ids']),
+        ]
 
     def __str__(self):
         return f"{self.customer} - {self.fingerprint}"
 
+    def save(self, *args, **kwargs):
+        if self._state.adding:
+            super().save(*args, **kwargs)
+            return
+        self.version = F('version') + 1
+        super().save(*args, **kwargs)
+        self.refresh_from_db(fields=['version'])
+
     def as_key(self):
-        return pgpy.PGPKey.from_blob(self.pgp_key)[0]
+        return pgp.key_cache.get(*self.key_ref())
+
+    def key_ref(self) -> pgp.KeyRef:
+        return self.fingerprint, self.version, self.pgp_key
+
+
+@receiver(post_save, sender=CustomerPGPKey)
+@receiver(post_delete, sender=CustomerPGPKey)
+def invalidate_pgp_key(instance, **_kwargs):
+    pgp.key_cache.invalidate(instance.fingerprint)
+    if CustomerPGPKey.customer.is_cached(instance):
+        instance.customer.invalidate_pgp_key_state()
+    else:
+        Customer(id=instance.customer_id).invalidate_pgp_key_state()
 
 
 @receiver(post_save, sender=settings.AUTH_USER_MODEL)
@@ -117,6 +189,12 @@ class Ticket(models.Model):
         (PRIORITY_HIGH, "High"),
         (PRIORITY_EMERGENCY, "Emergency"),
     )
+    TASK_PRIORITIES = {
+        PRIORITY_LOW: 1,
+        PRIORITY_NORMAL: 3,
+        PRIORITY_HIGH: 6,
+        PRIORITY_EMERGENCY: 9,
+    }
 
     id = as207960_utils.models.TypedUUIDField("support_ticket", primary_key=True)
     ref = models.CharField(max_length=64, db_index=True, default=make_ticket_ref)
@@ -130,6 +208,50 @@ class Ticket(models.Model):
     due_date = models.DateTimeField(blank=True, null=True)
     subject = models.CharField(max_length=255)
     deleted = models.BooleanField(blank=True, null=False, default=False)
+    first_message_date = models.DateTimeField(blank=True, null=True)
+    last_message_date = models.DateTimeField(blank=True, null=True)
+    last_message_type = models.CharField(max_length=1, blank=True, null=True)
+    awaiting_agent = models.BooleanField(blank=True, null=False, default=False)
+    message_count = models.PositiveIntegerField(blank=True, null=False, default=0)
+
+    SUMMARY_FIELDS = (
+        "first_message_date", "last_message_date", "last_message_type", "awaiting_agent", "message_count"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['state', 'deleted', 'awaiting_agent', '-last_message_date', '-id']),
+            models.Index(fields=['state', 'deleted', '-last_message_date', '-id']),
+            models.Index(fields=['assigned_to', 'deleted', '-last_message_date', '-id']),
+            models.Index(fields=['customer', '-last_message_date', '-id']),
+            GinIndex(fields=['subject'], opclasses=['gin_trgm_ops'], name='support_ticket_subject_trgm'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in self.SUMMARY_FIELDS
+            ]
+        super().save(*args, **kwargs)
+
+    @property
+    def task_priority(self) -> int:
+        return self.TASK_PRIORITIES.get(self.priority, 3)
+
+    def record_message(self, message: "TicketMessage"):
+        is_first = Q(first_message_date__isnull=True) | Q(first_message_date__gt=message.date)
+        is_last = Q(last_message_date__isnull=True) | Q(last_message_date__lte=message.date)
+        awaiting_agent = message.type in TicketMessage.AWAITING_AGENT_TYPES
+        Ticket.objects.filter(id=self.id).update(
+            message_count=F('message_count') + 1,
+            first_message_date=Case(When(is_first, then=Value(message.date)), default=F('first_message_date')),
+            last_message_date=Case(When(is_last, then=Value(message.date)), default=F('last_message_date')),
+            last_message_type=Case(When(is_last, then=Value(message.type)), default=F('last_message_type')),
+            awaiting_agent=Case(When(is_last, then=Value(awaiting_agent)), default=F('awaiting_agent')),
+        )
+
+        self.refresh_from_db(fields=self.SUMMARY_FIELDS)
 
     def first_message(self):
         return self.messages.order_by('date').first()
@@ -165,6 +287,32 @@ class Ticket(models.Model):
         return list(messages.values_list('email_message_id', flat=True))
 
 
+HTML_SANITIZER_VERSION = 1
+html_cleaner = lxml.html.clean.Cleaner(style=True, inline_style=False)
+
+
+def sanitize_html(html: str) -> str:
+    if not html or not html.strip():
+        return ""
+    doc = lxml.html.document_fromstring(html)
+    clean_doc = html_cleaner.clean_html(doc)
+    return lxml.html.tostring(clean_doc).decode()
+
+
+SEARCH_CONFIG = "english"
+FULL_TEXT_SEARCH_VENDORS = ("postgresql", "cockroachdb")
+
+
+def has_full_text_search() -> bool:
+    return connection.vendor in FULL_TEXT_SEARCH_VENDORS
+
+
+def html_to_text(html: str) -> str:
+    if not html or not html.strip():
+        return ""
+    return " ".join(lxml.html.document_fromstring(html).text_content().split())
+
+
 class TicketMessage(models.Model):
     TYPE_CUSTOMER = "C"
     TYPE_RESPONSE = "R"
@@ -178,6 +326,7 @@ class TicketMessage(models.Model):
         (TYPE_SYSTEM, "System"),
         (TYPE_SYSTEM_RESPONSE, "System Response"),
     )
+    AWAITING_AGENT_TYPES = (TYPE_CUSTOMER, TYPE_SYSTEM_RESPONSE)
 
     id = as207960_utils.models.TypedUUIDField("support_ticketmessage", primary_key=True)
     ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name='messages')
@@ -188,16 +337,124 @@ class TicketMessage(models.Model):
     pgp_signed_message = models.BooleanField(default=False, blank=True, null=False)
     pgp_signature_verified = models.BooleanField(default=False, blank=True, null=False)
     pgp_signing_key = models.ForeignKey(CustomerPGPKey, on_delete=models.SET_NULL, blank=True, null=True)
+    message_safe_html = models.TextField(blank=True, null=True)
+    message_safe_version = models.PositiveSmallIntegerField(blank=True, null=True, db_index=True)
+    search_text = models.TextField(blank=True, null=True)
+    search_vector = SearchVectorField(blank=True, null=True)
+    updated = models.DateTimeField(default=timezone.now)
 
     @property
     def message_safe(self):
-        doc = lxml.html.document_fromstring(self.message)
-        cleaner = lxml.html.clean.Cleaner(style=True, inline_style=False)
-        clean_doc = cleaner.clean_html(doc)
-        return lxml.html.tostring(clean_doc).decode()
+        if self.message_safe_version == HTML_SANITIZER_VERSION and self.message_safe_html is not None:
+            return self.message_safe_html
+        return sanitize_html(self.message)
+
+    def update_message_safe(self):
+        self.message_safe_html = sanitize_html(self.message)
+        self.message_safe_version = HTML_SANITIZER_VERSION
+        self.search_text = html_to_text(self.message_safe_html)
+
+    def save(self, *args, **kwargs):
+        if self.message_safe_version != HTML_SANITIZER_VERSION or self.search_text is None:
+            self.update_message_safe()
+        self.updated = timezone.now()
+        compute_search_vector = has_full_text_search()
+        if compute_search_vector:
+            self.search_vector = SearchVector(Value(self.search_text), config=SEARCH_CONFIG)
+        with transaction.atomic():
+            adding = self._state.adding
+            try:
+                super().save(*args, **kwargs)
+            finally:
+                if compute_search_vector:
+                    del self.search_vector
+            if adding:
+                self.ticket.record_message(self)
 
     class Meta:
         ordering = ['date']
+        indexes = [
+            GinIndex(fields=['search_vector']),
+        ]
+
+
+def hash_message_id(message_id: str) -> str:
+    return hashlib.sha256(message_id.strip().encode()).hexdigest()
+
+
+class EmailMessageID(models.Model):
+    id = as207960_utils.models.TypedUUIDField("support_emailmessageid", primary_key=True)
+    message_id_hash = models.CharField(max_length=64, unique=True)
+    email_message_id = models.TextField()
+    message = models.ForeignKey(
+        TicketMessage, on_delete=models.CASCADE, blank=True, null=True, related_name='email_message_ids'
+    )
+    ticket = models.ForeignKey(
+        Ticket, on_delete=models.CASCADE, blank=True, null=True, related_name='email_message_ids'
+    )
+
+    def __str__(self):
+        return self.email_message_id
+
+    @classmethod
+    def claim(cls, message_id: str):
+        try:
+            with transaction.atomic():
+                return cls.objects.create(
+                    message_id_hash=hash_message_id(message_id), email_message_id=message_id.strip()
+                )
+        except IntegrityError:
+            return None
+
+    @staticmethod
+    def find_open_ticket(message_ids: typing.List[str]):
+        return Ticket.objects.filter(
+            email_message_ids__message_id_hash__in=[hash_message_id(m) for m in message_ids]
+        ).exclude(state=Ticket.STATE_CLOSED).first()
+
+
+@receiver(post_save, sender=TicketMessage)
+def index_email_message_id(instance, **_kwargs):
+    if instance.email_message_id:
+        EmailMessageID.objects.update_or_create(
+            message_id_hash=hash_message_id(instance.email_message_id),
+            defaults={
+                "email_message_id": instance.email_message_id.strip(),
+                "message": instance,
+                "ticket_id": instance.ticket_id,
+            }
+        )
+
+
+class AttachmentBlob(models.Model):
+    id = as207960_utils.models.TypedUUIDField("support_attachmentblob", primary_key=True)
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField()
+    size = models.PositiveBigIntegerField()
+    ref_count = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.sha256
+
+    @staticmethod
+    def file_name(sha256: str, file_ext: typing.Optional[str]) -> str:
+        return f"blobs/{sha256[:2]}/{sha256}-{uuid.uuid4().hex[:8]}{file_ext or ''}"
+
+    @classmethod
+    def release(cls, blob_id):
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(id=blob_id).first()
+            if not blob:
+                return
+            if blob.ref_count > 1:
+                cls.objects.filter(id=blob_id).update(ref_count=F('ref_count') - 1)
+                return
+
+            file_name = blob.file.name
+            storage = blob.file.storage
+            blob.delete()
+            transaction.on_commit(lambda: storage.delete(file_name), robust=True)
 
 
 class TicketMessageAttachment(models.Model):
@@ -205,6 +462,112 @@ class TicketMessageAttachment(models.Model):
     message = models.ForeignKey(TicketMessage, on_delete=models.CASCADE)
     file_name = models.TextField(blank=True, null=True)
     file = models.FileField()
+    blob = models.ForeignKey(
+        AttachmentBlob, on_delete=models.PROTECT, blank=True, null=True, related_name='attachments'
+    )
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self._state.adding and self.blob_id:
+                AttachmentBlob.objects.filter(id=self.blob_id).update(ref_count=F('ref_count') + 1)
+            super().save(*args, **kwargs)
+
+
+MESSAGE_CARD_VERSION = 1
+MESSAGE_CARD_TEMPLATES = ("support/admin/message_card.html", "support/message_card.html")
+
+
+def message_card_cache_key(template_name: str, message: TicketMessage) -> str:
+    return support_cache.cache_key(
+        "message_card", MESSAGE_CARD_VERSION, HTML_SANITIZER_VERSION, template_name, message.id,
+        message.updated.timestamp()
+    )
+
+
+def invalidate_message_cards(message_ids):
+    TicketMessage.objects.filter(id__in=message_ids).update(updated=timezone.now())
+
+
+@receiver(post_save, sender=TicketMessageAttachment)
+@receiver(post_delete, sender=TicketMessageAttachment)
+def invalidate_attachment_message_card(instance, **_kwargs):
+    invalidate_message_cards([instance.message_id])
+
+
+@receiver(post_delete, sender=TicketMessageAttachment)
+def release_attachment_blob(instance, **_kwargs):
+    if instance.blob_id:
+        AttachmentBlob.release(instance.blob_id)
+
+
+@receiver(pre_delete, sender=CustomerPGPKey)
+def invalidate_signed_message_cards(instance, **_kwargs):
+    instance.ticketmessage_set.update(updated=timezone.now())
+
+
+class InboundEmail(models.Model):
+    STATE_PENDING = "P"
+    STATE_PROCESSED = "D"
+    STATE_FAILED = "F"
+    STATES = (
+        (STATE_PENDING, "Pending"),
+        (STATE_PROCESSED, "Processed"),
+        (STATE_FAILED, "Failed"),
+    )
+
+    id = as207960_utils.models.TypedUUIDField("support_inboundemail", primary_key=True)
+    received = models.DateTimeField(auto_now_add=True)
+    mail_from = models.TextField(blank=True, null=True)
+    rcpt_to = models.TextField(blank=True, null=True)
+    message = models.BinaryField(blank=True, null=True)
+    message_file = models.FileField(blank=True, null=True)
+    state = models.CharField(max_length=1, choices=STATES, default=STATE_PENDING, db_index=True)
+    processed = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['received']
+
+    @staticmethod
+    def file_name() -> str:
+        return f"inbound/{uuid.uuid4().hex}.eml"
+
+    def message_chunks(self) -> typing.Iterator[bytes]:
+        if not self.message_file:
+            yield bytes(self.message)
+            return
+        with self.message_file.open("rb") as f:
+            yield from f.chunks()
+
+
+class PendingNotification(models.Model):
+    id = as207960_utils.models.TypedUUIDField("support_pendingnotification", primary_key=True)
+    ticket = models.ForeignKey(Ticket, on_delete=models.CASCADE, related_name='pending_notifications')
+    title = models.TextField()
+    message = models.TextField()
+    timestamp = models.PositiveBigIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+
+class OutboxMessage(models.Model):
+    id = as207960_utils.models.TypedUUIDField("support_outboxmessage", primary_key=True)
+    task = models.CharField(max_length=255)
+    args = models.JSONField(encoder=DjangoJSONEncoder, default=list)
+    dedup_key = models.CharField(max_length=255, unique=True, blank=True, null=True)
+    priority = models.PositiveSmallIntegerField(blank=True, null=True)
+    trace_headers = models.JSONField(default=dict)
+    created = models.DateTimeField(auto_now_add=True)
+    dispatched = models.DateTimeField(blank=True, null=True)
+    dead_lettered = models.DateTimeField(blank=True, null=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created']
+        indexes = [
+            models.Index(fields=['dispatched', 'created']),
+            models.Index(fields=['dispatched', 'dead_lettered', 'next_attempt_at']),
+        ]
 
 
 class VerificationSession(models.Model):
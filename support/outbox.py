@@ -0,0 +1,92 @@
+from django.conf import settings
+from django.db import transaction, IntegrityError
+from django.db.models import F
+from django.utils import timezone
+import celery
+import datetime
+import logging
+import sentry_sdk
+import typing
+from . import models
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue(
+        task, *args, dedup_key: typing.Optional[str] = None, priority: typing.Optional[int] = None
+) -> typing.Optional[models.OutboxMessage]:
+    message = models.OutboxMessage(
+        task=getattr(task, "name", task), args=list(args), dedup_key=dedup_key, priority=priority,
+        trace_headers=trace_headers()
+    )
+    if not dedup_key:
+        message.save()
+        return message
+
+    try:
+        with transaction.atomic():
+            message.save()
+            return message
+    except IntegrityError:
+        return None
+
+
+def trace_headers() -> dict:
+    headers = {
+        "sentry-trace": sentry_sdk.get_traceparent(),
+        "baggage": sentry_sdk.get_baggage(),
+    }
+    return {k: v for k, v in headers.items() if v}
+
+
+def dispatch_pending(batch_size: typing.Optional[int] = None) -> int:
+    batch_size = batch_size or settings.OUTBOX_BATCH_SIZE
+    app = celery.current_app
+
+    with transaction.atomic():
+        now = timezone.now()
+        messages = list(
+            models.OutboxMessage.objects.select_for_update(skip_locked=True)
+            .filter(dispatched__isnull=True, dead_lettered__isnull=True, next_attempt_at__lte=now)
+            .order_by('next_attempt_at', 'created')[:batch_size]
+        )
+
+        sent = []
+        for message in messages:
+            trace = sentry_sdk.continue_trace(message.trace_headers, op="queue.publish", name=message.task)
+            try:
+                with sentry_sdk.start_transaction(trace):
+                    app.tasks[message.task].apply_async(
+                        args=message.args, task_id=str(message.id), priority=message.priority
+                    )
+            except Exception as e:
+                attempts = message.attempts + 1
+                update = {"attempts": attempts, "last_error": repr(e), "next_attempt_at": now + retry_delay(attempts)}
+                if attempts >= settings.OUTBOX_MAX_ATTEMPTS:
+                    logger.error(f"Giving up on outbox message {message.id} ({message.task}) after {attempts} attempts")
+                    update["dead_lettered"] = now
+                models.OutboxMessage.objects.filter(id=message.id).update(**update)
+            else:
+                sent.append(message.id)
+
+        models.OutboxMessage.objects.filter(id__in=sent).update(dispatched=timezone.now(), attempts=F('attempts') + 1)
+
+    return len(sent)
+
+
+def retry_delay(attempts: int) -> datetime.timedelta:
+    return datetime.timedelta(seconds=min(
+        settings.OUTBOX_RETRY_BACKOFF * (2 ** min(attempts - 1, 32)), settings.OUTBOX_RETRY_BACKOFF_MAX
+    ))
+
+
+def requeue_dead_letters() -> int:
+    return models.OutboxMessage.objects.filter(dispatched__isnull=True, dead_lettered__isnull=False).update(
+        dead_lettered=None, attempts=0, next_attempt_at=timezone.now()
+    )
+
+
+def purge_dispatched() -> int:
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.OUTBOX_RETENTION)
+    deleted, _ = models.OutboxMessage.objects.filter(dispatched__lt=cutoff).delete()
+    return deleted
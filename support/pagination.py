@@ -0,0 +1,105 @@
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models import F, Q
+import datetime
+import hashlib
+import typing
+from . import cache as support_cache
+
+
+class CursorPage:
+    def __init__(self, paginator: "CursorPaginator", object_list: list, next_cursor: typing.Optional[str],
+                 previous_cursor: typing.Optional[str]):
+        self.paginator = paginator
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self) -> bool:
+        return self.next_cursor is not None
+
+    def has_previous(self) -> bool:
+        return self.previous_cursor is not None
+
+    def has_other_pages(self) -> bool:
+        return self.has_next() or self.has_previous()
+
+
+class CursorPaginator:
+    salt = "support.pagination"
+
+    def __init__(self, queryset, per_page: int, field: str = "last_message_date"):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.field = field
+
+    @property
+    def count(self) -> int:
+        count_query = self.queryset.order_by()
+        cache_key = support_cache.cache_key("pagination_count", hashlib.sha256(
+            f"{count_query.model._meta.label}:{count_query.query}".encode()
+        ).hexdigest())
+        return cache.get_or_set(cache_key, count_query.count, settings.PAGINATION_COUNT_CACHE_TTL)
+
+    def make_cursor(self, obj, backwards: bool) -> str:
+        value = getattr(obj, self.field)
+        return signing.dumps({
+            "v": value.isoformat() if value else None,
+            "i": str(obj.pk),
+            "b": backwards,
+        }, salt=self.salt, compress=True)
+
+    def parse_cursor(self, cursor: typing.Optional[str]):
+        if not cursor:
+            return None
+        try:
+            data = signing.loads(cursor, salt=self.salt)
+            value = datetime.datetime.fromisoformat(data["v"]) if data["v"] else None
+            return value, data["i"], bool(data["b"])
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            return None
+
+    def _after(self, value, pk, backwards: bool) -> Q:
+        field = self.field
+        if not backwards:
+            if value is None:
+                return Q(**{f"{field}__isnull": True, "pk__lt": pk})
+            return Q(**{f"{field}__lt": value}) | Q(**{field: value, "pk__lt": pk}) | Q(**{f"{field}__isnull": True})
+        else:
+            if value is None:
+                return Q(**{f"{field}__isnull": False}) | Q(**{f"{field}__isnull": True, "pk__gt": pk})
+            return Q(**{f"{field}__gt": value}) | Q(**{field: value, "pk__gt": pk})
+
+    def get_page(self, cursor: typing.Optional[str]) -> CursorPage:
+        position = self.parse_cursor(cursor)
+        backwards = bool(position and position[2])
+
+        if backwards:
+            ordering = (F(self.field).asc(nulls_first=True), F("pk").asc())
+        else:
+            ordering = (F(self.field).desc(nulls_last=True), F("pk").desc())
+        queryset = self.queryset.order_by(*ordering)
+        if position:
+            queryset = queryset.filter(self._after(*position))
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if backwards:
+            object_list.reverse()
+
+        next_cursor = None
+        previous_cursor = None
+        if object_list:
+            if has_more or backwards:
+                next_cursor = self.make_cursor(object_list[-1], False)
+            if position and (has_more or not backwards):
+                previous_cursor = self.make_cursor(object_list[0], True)
+        return CursorPage(self, object_list, next_cursor, previous_cursor)
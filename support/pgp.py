@@ -0,0 +1,296 @@
+from django.conf import settings
+import celery.signals
+import atexit
+import billiard.process
+import collections
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import copy
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import typing
+import pgpy
+import sentry_sdk
+from . import metrics
+
+KeyRef = typing.Tuple[str, int, str]
+Blob = typing.Union[str, bytes]
+
+
+class KeyCache:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_cached(self, fingerprint: str, version: int) -> typing.Optional[pgpy.PGPKey]:
+        with self._lock:
+            key = self._keys.get((fingerprint, version))
+            if key is not None:
+                self._keys.move_to_end((fingerprint, version))
+            return key
+
+    def get(self, fingerprint: str, version: int, blob: str) -> pgpy.PGPKey:
+        key = self.get_cached(fingerprint, version)
+        if key is not None:
+            return key
+
+        key, _ = pgpy.PGPKey.from_blob(blob)
+        with self._lock:
+            self._keys[(fingerprint, version)] = key
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+        return key
+
+    def invalidate(self, fingerprint: str):
+        with self._lock:
+            for cache_key in [k for k in self._keys.keys() if k[0] == fingerprint]:
+                del self._keys[cache_key]
+
+    def clear(self):
+        with self._lock:
+            self._keys.clear()
+
+
+key_cache = KeyCache(settings.PGP_KEY_CACHE_SIZE)
+
+
+class ServiceKey:
+    def __init__(self, path: str, passphrase: str):
+        self.path = path
+        self.passphrase = passphrase
+        self._key = None
+        self._key_mtime = None
+        self._unlock_ctx = None
+        self._lock = threading.RLock()
+
+    def _check_rotation(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if self._key is None or mtime != self._key_mtime:
+            self._relock()
+            self._key, _ = pgpy.PGPKey.from_file(self.path)
+            self._key_mtime = mtime
+
+    def _relock(self):
+        if self._unlock_ctx is not None:
+            self._unlock_ctx.__exit__(None, None, None)
+            self._unlock_ctx = None
+
+    @property
+    def key(self) -> pgpy.PGPKey:
+        with self._lock:
+            self._check_rotation()
+            return self._key
+
+    @property
+    def pubkey(self) -> pgpy.PGPKey:
+        return self.key.pubkey
+
+    @contextlib.contextmanager
+    def unlocked(self):
+        with self._lock:
+            self._check_rotation()
+            if self._unlock_ctx is None:
+                unlock_ctx = self._key.unlock(self.passphrase)
+                unlock_ctx.__enter__()
+                self._unlock_ctx = unlock_ctx
+            # callers get their own unlocked copy so operations run in parallel and survive a relock
+            key = copy.copy(self._key)
+        yield key
+
+    def lock(self):
+        with self._lock:
+            self._relock()
+
+
+service_key = ServiceKey(settings.PGP_PRIVATE_KEY_FILE, settings.PGP_PRIVATE_KEY_PASSWORD)
+atexit.register(service_key.lock)
+
+
+@celery.signals.worker_process_shutdown.connect
+def lock_service_key(**_kwargs):
+    service_key.lock()
+
+
+def in_daemon_process() -> bool:
+    return multiprocessing.current_process().daemon or billiard.process.current_process().daemon
+
+
+class OperationPool:
+    def __init__(self, size: int, timeout: float):
+        self.size = size
+        self.timeout = timeout
+        self._slots = None
+        self._slots_pid = None
+        self._pending = 0
+        self._stats = collections.defaultdict(lambda: {
+            "count": 0,
+            "errors": 0,
+            "timeouts": 0,
+            "total_time": 0.0,
+            "max_time": 0.0,
+        })
+        self._lock = threading.Lock()
+
+    def _get_slots(self) -> queue.LifoQueue:
+        with self._lock:
+            if self._slots is None or self._slots_pid != os.getpid():
+                self._slots = queue.LifoQueue()
+                for _ in range(self.size):
+                    self._slots.put(None)
+                self._slots_pid = os.getpid()
+            return self._slots
+
+    @staticmethod
+    def _new_executor() -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=1, mp_context=multiprocessing.get_context("forkserver")
+        )
+
+    @staticmethod
+    def _kill(executor: concurrent.futures.ProcessPoolExecutor):
+        for process in list((executor._processes or {}).values()):
+            process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run_in_slot(self, fn, *args):
+        slots = self._get_slots()
+        wait_start = time.monotonic()
+        metrics.PGP_QUEUE_DEPTH.inc()
+        try:
+            executor = slots.get(timeout=self.timeout)
+        except queue.Empty:
+            raise TimeoutError(f"No PGP worker available after {self.timeout}s")
+        finally:
+            metrics.PGP_QUEUE_DEPTH.dec()
+            metrics.PGP_QUEUE_WAIT.observe(time.monotonic() - wait_start)
+
+        try:
+            if executor is None:
+                executor = self._new_executor()
+            future = executor.submit(fn, *args)
+            try:
+                return future.result(timeout=self.timeout)
+            except (TimeoutError, concurrent.futures.process.BrokenProcessPool):
+                self._kill(executor)
+                executor = None
+                raise
+        finally:
+            slots.put(executor)
+
+    def run(self, fn, *args):
+        start = time.monotonic()
+        with self._lock:
+            self._pending += 1
+        metrics.PGP_IN_PROGRESS.inc()
+        stat_key = "count"
+        try:
+            with sentry_sdk.start_span(op="pgp", name=fn.__name__.lstrip("_")):
+                if self.size <= 0 or in_daemon_process():
+                    return fn(*args)
+                return self._run_in_slot(fn, *args)
+        except TimeoutError:
+            stat_key = "timeouts"
+            raise
+        except Exception:
+            stat_key = "errors"
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.PGP_IN_PROGRESS.dec()
+            metrics.PGP_OPERATION_LATENCY.labels(
+                fn.__name__.lstrip("_"), "ok" if stat_key == "count" else stat_key
+            ).observe(elapsed)
+            with self._lock:
+                self._pending -= 1
+                stats = self._stats[fn.__name__.lstrip("_")]
+                stats[stat_key] += 1
+                if stat_key != "count":
+                    stats["count"] += 1
+                stats["total_time"] += elapsed
+                stats["max_time"] = max(stats["max_time"], elapsed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "pending": self._pending,
+                "operations": {k: dict(v) for k, v in self._stats.items()},
+            }
+
+    def shutdown(self):
+        with self._lock:
+            slots = self._slots if self._slots_pid == os.getpid() else None
+            self._slots = None
+        while slots is not None and not slots.empty():
+            executor = slots.get_nowait()
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+
+pool = OperationPool(settings.PGP_POOL_SIZE, settings.PGP_OPERATION_TIMEOUT)
+atexit.register(pool.shutdown)
+
+
+def key_ids(key: pgpy.PGPKey) -> typing.List[str]:
+    return [str(key.fingerprint.keyid)] + [str(k) for k in key.subkeys.keys()]
+
+
+def _parse_key(blob: Blob) -> typing.Tuple[str, typing.List[str], str]:
+    key, _ = pgpy.PGPKey.from_blob(blob)
+    return str(key.fingerprint), key_ids(key), str(key)
+
+
+def _sign_detached(data: str) -> str:
+    tbs_msg = pgpy.PGPMessage.new(data, cleartext=True)
+    with service_key.unlocked() as own_priv_key:
+        return str(own_priv_key.sign(tbs_msg))
+
+
+def _sign_and_encrypt(data: str, recipient: KeyRef) -> str:
+    tbs_msg = pgpy.PGPMessage.new(data)
+    with service_key.unlocked() as own_priv_key:
+        tbs_msg |= own_priv_key.sign(tbs_msg)
+    return str(key_cache.get(*recipient).encrypt(tbs_msg))
+
+
+def _decrypt(blob: Blob) -> typing.Tuple[bytes, str, typing.List[str]]:
+    enc_msg = pgpy.PGPMessage.from_blob(blob)
+    with service_key.unlocked() as own_priv_key:
+        dec_msg = own_priv_key.decrypt(enc_msg)
+    message = dec_msg.message
+    if isinstance(message, str):
+        message = message.encode()
+    return bytes(message), str(dec_msg), [str(s.signer) for s in dec_msg.signatures if s.signer]
+
+
+def _verify(key: KeyRef, message: Blob, signature: typing.Optional[Blob]) -> bool:
+    if signature is None:
+        message = pgpy.PGPMessage.from_blob(message)
+    else:
+        signature = pgpy.PGPSignature.from_blob(signature)
+    return bool(key_cache.get(*key).verify(message, signature))
+
+
+def parse_key(blob: Blob) -> typing.Tuple[str, typing.List[str], str]:
+    return pool.run(_parse_key, blob)
+
+
+def sign_detached(data: str) -> str:
+    return pool.run(_sign_detached, data)
+
+
+def sign_and_encrypt(data: str, recipient: KeyRef) -> str:
+    return pool.run(_sign_and_encrypt, data, recipient)
+
+
+def decrypt(blob: Blob) -> typing.Tuple[bytes, str, typing.List[str]]:
+    return pool.run(_decrypt, blob)
+
+
+def verify(key: KeyRef, message: Blob, signature: typing.Optional[Blob] = None) -> bool:
+    return pool.run(_verify, key, message, signature)
@@ -0,0 +1,192 @@
+from django.conf import settings
+import base64
+import json
+import re
+import tempfile
+import typing
+import cryptography.exceptions
+import cryptography.hazmat.primitives.asymmetric.padding
+import cryptography.hazmat.primitives.asymmetric.utils
+import cryptography.hazmat.primitives.hashes
+import cryptography.hazmat.primitives.serialization
+from . import inbound
+
+CHUNK_SIZE = 64 * 1024
+STRING_SPECIAL = re.compile(rb'["\\]')
+SURROGATE_PAIR = re.compile(rb"u[dD][89abAB][0-9a-fA-F]{2}\\u")
+WHITESPACE = b" \t\r\n"
+LITERAL_CHARS = b"+-.0123456789Eabcdefilnrstu"
+
+
+class PayloadError(ValueError):
+    pass
+
+
+class PayloadTooLarge(PayloadError):
+    pass
+
+
+def read_body(stream: typing.BinaryIO, max_size: int) -> typing.Tuple[typing.IO[bytes], bytes]:
+    body = tempfile.SpooledTemporaryFile(max_size=settings.POSTAL_WEBHOOK_SPOOL_MAX_SIZE)
+    digest = cryptography.hazmat.primitives.hashes.Hash(cryptography.hazmat.primitives.hashes.SHA1())
+    size = 0
+    try:
+        while chunk := stream.read(CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_size:
+                raise PayloadTooLarge(f"Webhook body exceeds {max_size} bytes")
+            body.write(chunk)
+            digest.update(chunk)
+    except Exception:
+        body.close()
+        raise
+    body.seek(0)
+    return body, digest.finalize()
+
+
+def verify_signature(signature: bytes, digest: bytes) -> bool:
+    pubkey = cryptography.hazmat.primitives.serialization.load_der_public_key(
+        base64.b64decode(settings.POSTAL_PUBLIC_KEY)
+    )
+    try:
+        pubkey.verify(
+            signature, digest,
+            cryptography.hazmat.primitives.asymmetric.padding.PKCS1v15(),
+            cryptography.hazmat.primitives.asymmetric.utils.Prehashed(cryptography.hazmat.primitives.hashes.SHA1())
+        )
+    except cryptography.exceptions.InvalidSignature:
+        return False
+    return True
+
+
+class JSONStreamReader:
+    def __init__(self, fp: typing.BinaryIO):
+        self.fp = fp
+        self.buf = b""
+        self.pos = 0
+
+    def _fill(self, size: int = 1) -> bool:
+        while len(self.buf) - self.pos < size:
+            chunk = self.fp.read(CHUNK_SIZE)
+            if not chunk:
+                return False
+            self.buf = self.buf[self.pos:] + chunk
+            self.pos = 0
+        return True
+
+    def peek(self) -> bytes:
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos:self.pos + 1]
+            if not self._fill():
+                return b""
+
+    def expect(self, token: bytes):
+        if self.peek() != token:
+            raise PayloadError(f"Expected {token!r} in webhook payload")
+        self.pos += 1
+
+    def expect_end(self):
+        if self.peek():
+            raise PayloadError("Trailing data in webhook payload")
+
+    def iter_string(self) -> typing.Iterator[bytes]:
+        self.expect(b'"')
+        while True:
+            if not self._fill():
+                raise PayloadError("Unterminated string in webhook payload")
+            match = STRING_SPECIAL.search(self.buf, self.pos)
+            if not match:
+                yield self.buf[self.pos:]
+                self.pos = len(self.buf)
+                continue
+            if match.start() > self.pos:
+                yield self.buf[self.pos:match.start()]
+            self.pos = match.end()
+            if match.group() == b'"':
+                return
+
+            if self._fill() and self.buf[self.pos:self.pos + 1] == b"u":
+                escape_length = 11 if self._fill(11) and SURROGATE_PAIR.match(self.buf, self.pos) else 5
+            else:
+                escape_length = 1
+            if not self._fill(escape_length):
+                raise PayloadError("Truncated escape in webhook payload")
+            escape = self.buf[self.pos:self.pos + escape_length]
+            self.pos += escape_length
+            try:
+                yield json.loads(b'"\\' + escape + b'"').encode("utf-8", "surrogatepass")
+            except json.JSONDecodeError as e:
+                raise PayloadError(f"Invalid escape in webhook payload: {e}") from e
+
+    def iter_object(self) -> typing.Iterator[str]:
+        self.expect(b"{")
+        if self.peek() == b"}":
+            self.pos += 1
+            return
+        while True:
+            key = self.read_string()
+            self.expect(b":")
+            yield key
+            if self.peek() == b",":
+                self.pos += 1
+            else:
+                self.expect(b"}")
+                return
+
+    def read_string(self) -> str:
+        try:
+            return b"".join(self.iter_string()).decode("utf-8")
+        except UnicodeError as e:
+            raise PayloadError(f"Invalid string in webhook payload: {e}") from e
+
+    def read_value(self):
+        token = self.peek()
+        if token == b'"':
+            return self.read_string()
+        elif token == b"{":
+            return {key: self.read_value() for key in self.iter_object()}
+        elif token == b"[":
+            self.pos += 1
+            values = []
+            if self.peek() == b"]":
+                self.pos += 1
+                return values
+            while True:
+                values.append(self.read_value())
+                if self.peek() == b",":
+                    self.pos += 1
+                else:
+                    self.expect(b"]")
+                    return values
+
+        literal = b""
+        while self._fill() and self.buf[self.pos] in LITERAL_CHARS:
+            literal += self.buf[self.pos:self.pos + 1]
+            self.pos += 1
+        try:
+            return json.loads(literal)
+        except json.JSONDecodeError as e:
+            raise PayloadError(f"Invalid value in webhook payload: {e}") from e
+
+
+def read_payload(fp: typing.BinaryIO) -> typing.Tuple[dict, typing.IO[bytes]]:
+    reader = JSONStreamReader(fp)
+    fields = {}
+    message = tempfile.SpooledTemporaryFile(max_size=settings.POSTAL_WEBHOOK_SPOOL_MAX_SIZE)
+    try:
+        for key in reader.iter_object():
+            if key == "message" and reader.peek() == b'"':
+                fields[key] = True
+                for chunk in inbound.decode_base64(reader.iter_string()):
+                    message.write(chunk)
+            else:
+                fields[key] = reader.read_value()
+        reader.expect_end()
+    except Exception:
+        message.close()
+        raise
+    message.seek(0)
+    return fields, message
@@ -0,0 +1,173 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db.models import Case, F, FloatField, Max, Q, Value, When, lookups
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+import abc
+import dataclasses
+import re
+import typing
+from . import models
+
+
+@dataclasses.dataclass
+class SearchResult:
+    ticket: models.Ticket
+    rank: float
+    subject: str
+    snippet: str
+
+
+def query_terms(query: str) -> typing.List[str]:
+    terms = []
+    for term in re.findall(r"[\w@.+-]+", query.lower()):
+        term = term.strip(".-+")
+        if term and term not in terms:
+            terms.append(term)
+    return terms
+
+
+def highlight(text: typing.Optional[str], terms: typing.List[str], width: int = 240) -> str:
+    if not text:
+        return ""
+    if not terms:
+        return escape(text[:width])
+
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    match = pattern.search(text)
+    start = max(0, match.start() - width // 3) if match else 0
+    end = min(len(text), start + width)
+    snippet = text[start:end]
+
+    parts = []
+    last = 0
+    for match in pattern.finditer(snippet):
+        parts.append(escape(snippet[last:match.start()]))
+        parts.append(f"<mark>{escape(match.group(0))}</mark>")
+        last = match.end()
+    parts.append(escape(snippet[last:]))
+
+    return mark_safe(("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else ""))
+
+
+def ticket_filters(filters: dict, prefix: str = "") -> Q:
+    q = Q(**{f"{prefix}deleted": False})
+    if filters.get("state"):
+        q &= Q(**{f"{prefix}state": filters["state"]})
+    if filters.get("priority"):
+        q &= Q(**{f"{prefix}priority": filters["priority"]})
+    if filters.get("assigned_to"):
+        q &= Q(**{f"{prefix}assigned_to": filters["assigned_to"]})
+    if filters.get("date_from"):
+        q &= Q(**{f"{prefix}last_message_date__gte": filters["date_from"]})
+    if filters.get("date_to"):
+        q &= Q(**{f"{prefix}last_message_date__lte": filters["date_to"]})
+    return q
+
+
+class ILike(lookups.IContains):
+    def as_sql(self, compiler, connection):
+        return lookups.IContains(self.lhs, self.rhs).as_sql(compiler, connection)
+
+    def as_postgresql(self, compiler, connection):
+        lhs_sql, lhs_params = self.process_lhs(compiler, connection)
+        rhs_sql, rhs_params = self.process_rhs(compiler, connection)
+        return f"{lhs_sql} ILIKE {rhs_sql}", (*lhs_params, *rhs_params)
+
+    as_cockroachdb = as_postgresql
+
+
+class SearchBackend(abc.ABC):
+    def field_hits(self, query: str, filters: dict, limit: int) -> typing.Dict[str, float]:
+        query = query.strip()
+        ref = query.lstrip("#").upper()
+        matches = Q(ref=ref) | Q(ILike(F("subject"), query)) | \
+            Q(ILike(F("customer__email"), query)) | Q(ILike(F("customer__full_name"), query))
+        hits = models.Ticket.objects.filter(ticket_filters(filters), matches).annotate(
+            field_rank=Case(
+                When(ref=ref, then=Value(2.0)),
+                When(ILike(F("subject"), query), then=Value(1.0)),
+                default=Value(0.5),
+                output_field=FloatField(),
+            )
+        ).order_by('-field_rank', F('last_message_date').desc(nulls_last=True)).values_list('id', 'field_rank')
+        return dict(hits[:limit])
+
+    @abc.abstractmethod
+    def message_hits(
+            self, query: str, terms: typing.List[str], filters: dict, limit: int
+    ) -> typing.Dict[str, typing.Tuple[float, str]]:
+        ...
+
+    def search(self, query: str, filters: typing.Optional[dict] = None, limit: int = 50) -> typing.List[SearchResult]:
+        filters = filters or {}
+        terms = query_terms(query)
+        if not terms:
+            return []
+
+        field_hits = self.field_hits(query, filters, limit)
+        message_hits = self.message_hits(query, terms, filters, limit)
+
+        ranks = dict(field_hits)
+        for ticket_id, (rank, _) in message_hits.items():
+            ranks[ticket_id] = ranks.get(ticket_id, 0.0) + rank
+        ticket_ids = sorted(ranks.keys(), key=lambda t: ranks[t], reverse=True)[:limit]
+
+        tickets = models.Ticket.objects.select_related('customer', 'assigned_to').in_bulk(ticket_ids)
+        results = []
+        for ticket_id in ticket_ids:
+            ticket = tickets.get(ticket_id)
+            if not ticket:
+                continue
+            _, text = message_hits.get(ticket_id, (0.0, None))
+            results.append(SearchResult(
+                ticket=ticket,
+                rank=ranks[ticket_id],
+                subject=highlight(ticket.subject, terms, width=len(ticket.subject)),
+                snippet=highlight(text, terms),
+            ))
+        return results
+
+
+class SimpleSearchBackend(SearchBackend):
+    def message_hits(self, query, terms, filters, limit):
+        matches = Q()
+        for term in terms:
+            matches &= Q(search_text__icontains=term)
+        messages = models.TicketMessage.objects.filter(ticket_filters(filters, "ticket__"), matches) \
+            .order_by('-date').values_list('ticket_id', 'search_text')
+
+        hits = {}
+        for ticket_id, text in messages[:limit * 10]:
+            lower_text = text.lower()
+            rank = sum(lower_text.count(term) for term in terms) / (1 + len(lower_text) / 1000)
+            if ticket_id not in hits or hits[ticket_id][0] < rank:
+                hits[ticket_id] = (rank, text)
+        return dict(sorted(hits.items(), key=lambda h: h[1][0], reverse=True)[:limit])
+
+
+class PostgresSearchBackend(SearchBackend):
+    def message_hits(self, query, terms, filters, limit):
+        search_query = SearchQuery(query, config=models.SEARCH_CONFIG, search_type="plain")
+        messages = models.TicketMessage.objects.filter(
+            ticket_filters(filters, "ticket__"), search_vector=search_query
+        ).annotate(rank=SearchRank(F('search_vector'), search_query))
+
+        top_tickets = messages.values('ticket_id').annotate(best_rank=Max('rank')).order_by('-best_rank')
+        ranks = {t['ticket_id']: t['best_rank'] for t in top_tickets[:limit]}
+        if not ranks:
+            return {}
+
+        best_messages = messages.filter(ticket_id__in=ranks.keys()) \
+            .order_by('ticket_id', '-rank').distinct('ticket_id').values_list('ticket_id', 'search_text')
+        texts = dict(best_messages)
+        return {ticket_id: (rank, texts.get(ticket_id)) for ticket_id, rank in ranks.items()}
+
+
+def get_backend() -> SearchBackend:
+    if models.has_full_text_search():
+        return PostgresSearchBackend()
+    return SimpleSearchBackend()
+
+
+def search(query: str, filters: typing.Optional[dict] = None, limit: int = 50) -> typing.List[SearchResult]:
+    return get_backend().search(query, filters, limit)
@@ -1,17 +1,20 @@
 import django.core.mail
 import html2text
-from . import models
+from . import models, pgp, outbox, metrics
+from . import cache as support_cache
+from .db import retry_transaction
 from django.utils import timezone
 from django.template.loader import render_to_string
 from django.core.mail import EmailMultiAlternatives
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
 from django.shortcuts import reverse
 from celery import shared_task
 import email.mime.multipart
 import email.message
 import email.generator
 import email.header
-import pgpy
 import requests
 import secrets
 import typing
@@ -19,8 +22,6 @@ import stripe.identity
 import django_keycloak_auth.clients
 
 
-own_priv_key, _ = pgpy.PGPKey.from_file(settings.PGP_PRIVATE_KEY_FILE)
-
 class PGPEmail(EmailMultiAlternatives):
     customer: typing.Optional[models.Customer]
 
@@ -28,6 +29,7 @@ class PGPEmail(EmailMultiAlternatives):
         super().__init__(*args, **kwargs)
         self.customer = customer
 
+    @metrics.phase("outbound_email", "message")
     def message(self):
         base_msg = super().message()
         for part in base_msg.walk():
@@ -36,7 +38,7 @@ class PGPEmail(EmailMultiAlternatives):
                 part.set_charset(django.core.mail.message.utf8_charset_qp)
 
         if self.customer:
-            enc_pgp_key = self.customer.pgp_keys.filter(primary=True).first()
+            enc_pgp_key = self.customer.primary_pgp_key()
         else:
             enc_pgp_key = None
 
@@ -85,21 +87,17 @@ class PGPEmail(EmailMultiAlternatives):
             enc_msg = email.message.Message()
             enc_msg['Content-Type'] = 'application/octet-stream; name="encrypted.asc"'
             enc_msg['Content-Description'] = 'OpenPGP encrypted message'
-            tbs_msg = pgpy.PGPMessage.new(base_msg_str)
-            with own_priv_key.unlock(settings.PGP_PRIVATE_KEY_PASSWORD):
-                tbs_msg |= own_priv_key.sign(tbs_msg)
-            enc_pgp_key = enc_pgp_key.as_key()
-            enc = enc_pgp_key.encrypt(tbs_msg)
-            enc_msg.set_payload(str(enc))
+            with metrics.phase("outbound_email", "pgp_encrypt"):
+                enc = pgp.sign_and_encrypt(base_msg_str, enc_pgp_key.key_ref())
+            enc_msg.set_payload(enc)
             new_msg.attach(enc_msg)
         else:
-            tbs_msg = pgpy.PGPMessage.new(base_msg_str, cleartext=True)
-            with own_priv_key.unlock(settings.PGP_PRIVATE_KEY_PASSWORD):
-                signature = own_priv_key.sign(tbs_msg)
+            with metrics.phase("outbound_email", "pgp_sign"):
+                signature = pgp.sign_detached(base_msg_str)
             sig_msg = email.message.Message()
             sig_msg['Content-Type'] = 'application/pgp-signature; name="signature.asc"'
             sig_msg['Content-Description'] = 'OpenPGP digital signature'
-            sig_msg.set_payload(str(signature))
+            sig_msg.set_payload(signature)
             new_msg.set_boundary(email.generator._make_boundary(base_msg_str))
             new_msg.set_payload(
                 "--%(boundary)s\n%(mix)s\n--%(boundary)s\n%(sign)s\n--%(boundary)s--\n" % {
@@ -146,7 +144,7 @@ def make_ticket_email(ticket: models.Ticket, message_id=None) -> EmailMultiAlter
         headers=headers,
         customer=ticket.customer,
     )
-    pubkey = own_priv_key.pubkey
+    pubkey = pgp.service_key.pubkey
     email.attach(f"OpenPGP_{pubkey.fingerprint}.asc", str(pubkey), "application/pgp-keys")
     return email
 
@@ -213,7 +211,7 @@ def send_email_blocked(customer_id, message_id):
         customer=customer,
     )
     email.attach_alternative(html_content, "text/html")
-    pubkey = own_priv_key.pubkey
+    pubkey = pgp.service_key.pubkey
     email.attach(f"OpenPGP_{pubkey.fingerprint}.asc", str(pubkey), "application/pgp-keys")
     email.send()
 
@@ -241,6 +239,7 @@ def send_email_decryption_failed(to_email, message_id):
     email.send()
 
 
+@retry_transaction
 def open_ticket(
         customer: models.Customer, subject: str, html_message: str, source: str, priority: str, verified: bool = False,
         email_id: str = None, date=None,
@@ -268,18 +267,24 @@ def open_ticket(
     )
     ticket_message.save()
 
-    send_open_ticket_email.delay(ticket.id, verified)
+    outbox.enqueue(
+        send_open_ticket_email, ticket.id, verified,
+        dedup_key=f"open_ticket_email:{ticket.id}", priority=ticket.task_priority
+    )
 
-    send_notification.delay(
+    outbox.enqueue(
+        send_notification,
         ticket.id,
         f"New ticket from {customer.full_name}",
         f"Ticket ref: #{ticket.ref}\nSubject: {ticket.subject}\nPriority: {ticket.get_priority_display()}",
-        int(ticket_message.date.timestamp())
+        int(ticket_message.date.timestamp()),
+        dedup_key=f"notification:{ticket_message.id}", priority=ticket.task_priority
     )
 
     return ticket_message
 
 
+@retry_transaction
 def post_message(
         ticket: models.Ticket, message: str, email_id: str = None, date=None,
         is_pgp_signed: bool = False, is_pgp_verified: bool = False, customer_pgp_key: typing.Optional[str] = None,
@@ -297,11 +302,13 @@ def post_message(
     )
     ticket_message.save()
 
-    send_notification.delay(
+    outbox.enqueue(
+        send_notification,
         ticket.id,
         f"New message from {ticket.customer.full_name}",
         f"Ticket ref: #{ticket.ref}\nSubject: {ticket.subject}",
-        int(ticket_message.date.timestamp())
+        int(ticket_message.date.timestamp()),
+        dedup_key=f"notification:{ticket_message.id}", priority=ticket.task_priority
     )
 
     return ticket_message
@@ -332,6 +339,7 @@ def send_reply_email(message_id):
     email.send()
 
 
+@retry_transaction
 def post_reply(ticket: models.Ticket, message: str, agent):
     message = f"<p>Hi {ticket.customer.full_name},</p>\r\n{message}\r\n<p>Thanks,<br/>{agent.first_name}</p>"
 
@@ -344,7 +352,10 @@ def post_reply(ticket: models.Ticket, message: str, agent):
     ticket_message.email_message_id = f"<{ticket_message.id}@support.glauca.digital>"
     ticket_message.save()
 
-    send_reply_email.delay(ticket_message.id)
+    outbox.enqueue(
+        send_reply_email, ticket_message.id,
+        dedup_key=f"reply_email:{ticket_message.id}", priority=ticket.task_priority
+    )
 
 
 def post_note(ticket: models.Ticket, message: str):
@@ -357,6 +368,7 @@ def post_note(ticket: models.Ticket, message: str):
     ticket_message.save()
 
 
+@retry_transaction
 def claim_ticket(ticket: models.Ticket, agent):
     ticket_message = models.TicketMessage(
         ticket=ticket,
@@ -392,6 +404,7 @@ def send_close_ticket_email(ticket_id):
     email.send()
 
 
+@retry_transaction
 def close_ticket(ticket: models.Ticket, message: str = "", silent: bool = False):
     ticket.state = ticket.STATE_CLOSED
     ticket.save()
@@ -405,9 +418,13 @@ def close_ticket(ticket: models.Ticket, message: str = "", silent: bool = False)
     ticket_message.save()
 
     if not silent:
-        send_close_ticket_email.delay(ticket.id)
+        outbox.enqueue(
+            send_close_ticket_email, ticket.id,
+            dedup_key=f"close_ticket_email:{ticket_message.id}", priority=ticket.task_priority
+        )
 
 
+@retry_transaction
 def reopen_ticket(ticket: models.Ticket, message: str = ""):
     ticket.state = ticket.STATE_OPEN
     ticket.save()
@@ -450,61 +467,132 @@ def request_kyc(ticket: models.Ticket):
         verification_flow="vf_1TNaWlC8TgZqcfVo5bQkAqnE",
         client_reference_id=str(ticket.id)
     )
+    record_kyc_request(ticket, verification_session.id)
+
 
+@retry_transaction
+def record_kyc_request(ticket: models.Ticket, stripe_session_id: str):
     verification_session_obj = models.VerificationSession(
         ticket=ticket,
-        stripe_session=verification_session.id
+        stripe_session=stripe_session_id
     )
     verification_session_obj.save()
 
     ticket_message = models.TicketMessage(
         ticket=ticket,
         type=models.TicketMessage.TYPE_SYSTEM,
-        message=f"<p>Request for identity verification sent.<br/>Session ID: <code>{verification_session.id}</code></p>",
+        message=f"<p>Request for identity verification sent.<br/>Session ID: <code>{stripe_session_id}</code></p>",
         date=timezone.now()
     )
     ticket_message.save()
 
-    send_kyc_email.delay(verification_session_obj.id)
+    outbox.enqueue(
+        send_kyc_email, verification_session_obj.id,
+        dedup_key=f"kyc_email:{verification_session_obj.id}", priority=ticket.task_priority
+    )
 
 
-@shared_task(
-    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3
-)
-def send_notification(ticket_id, title: str, message: str, timestamp: int):
-    ticket = models.Ticket.objects.get(id=ticket_id)
+pushover_session = requests.Session()
+
 
+def send_pushover(user_key: str, title: str, message: str, timestamp: int, ticket: typing.Optional[models.Ticket]):
+    data = {
+        "token": settings.PUSHOVER_APP_TOKEN,
+        "user": user_key,
+        "title": title[:250],
+        "message": message[:1024],
+        "timestamp": timestamp
+    }
+
+    if ticket:
+        data["url"] = settings.EXTERNAL_URL_BASE + reverse('agent-view-ticket', args=(ticket.id,))
+        data["url_title"] = f"View ticket #{ticket.ref}"
+
+    r = pushover_session.post("https://api.pushover.net/1/messages.json", data=data, timeout=30)
+    r.raise_for_status()
+
+
+def notification_recipients(ticket: models.Ticket) -> typing.List[str]:
     if ticket.assigned_to:
         agent = ticket.assigned_to.customer
-        if agent.pushover_user_key:
-            send_single_notification.delay(agent.id, title, message, timestamp, ticket.id)
+        return [agent.pushover_user_key] if agent.pushover_user_key else []
+    else:
+        return list(models.Customer.objects.filter(
+            is_agent=True, pushover_user_key__isnull=False
+        ).values_list("pushover_user_key", flat=True))
+
+
+def dispatch_notifications(ticket: models.Ticket, notifications: typing.List[models.PendingNotification]):
+    if len(notifications) == 1:
+        title = notifications[0].title
+        message = notifications[0].message
     else:
-        for agent in models.Customer.objects.filter(
-                is_agent=True, pushover_user_key__isnull=False
-        ):
-            send_single_notification.delay(agent.id, title, message, timestamp, ticket.id)
+        title = f"{len(notifications)} updates on ticket #{ticket.ref}"
+        message = "\n\n".join(f"{n.title}\n{n.message}" for n in notifications)
+    timestamp = max(n.timestamp for n in notifications)
+
+    for user_key in notification_recipients(ticket):
+        send_pushover_notification.apply_async(
+            (user_key, title, message, timestamp, ticket.id), priority=ticket.task_priority
+        )
 
 
 @shared_task(
-    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=10, default_retry_delay=3
 )
-def send_single_notification(customer_id, title: str, message: str, timestamp: int, ticket_id: typing.Optional[str]):
-    customer = models.Customer.objects.get(id=customer_id)
+def send_pushover_notification(user_key: str, title: str, message: str, timestamp: int, ticket_id):
+    ticket = models.Ticket.objects.filter(id=ticket_id).first()
+    send_pushover(user_key, title, message, timestamp, ticket)
 
-    data = {
-        "token": settings.PUSHOVER_APP_TOKEN,
-        "user": customer.pushover_user_key,
-        "title": title,
-        "message": message,
-        "timestamp": timestamp
-    }
 
-    if ticket_id:
-        ticket = models.Ticket.objects.get(id=ticket_id)
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=10, default_retry_delay=3
+)
+def send_notification(ticket_id, title: str, message: str, timestamp: int):
+    notification = models.PendingNotification(
+        ticket_id=ticket_id,
+        title=title,
+        message=message,
+        timestamp=timestamp,
+    )
+
+    ticket = models.Ticket.objects.select_related("assigned_to__customer").get(id=ticket_id)
+    window = settings.NOTIFICATION_COALESCE_WINDOW
+    if window <= 0 or ticket.priority == models.Ticket.PRIORITY_EMERGENCY:
+        dispatch_notifications(ticket, [notification])
+        return
 
-        data["url"] = settings.EXTERNAL_URL_BASE + reverse('agent-view-ticket', args=(ticket.id,))
-        data["url_title"] = f"View ticket #{ticket.ref}"
+    notification.save()
+    if cache.add(support_cache.cache_key("notification_flush", ticket_id), True, window + 60):
+        flush_notifications.apply_async((ticket_id,), countdown=window, priority=ticket.task_priority)
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=10, default_retry_delay=3
+)
+def flush_notifications(ticket_id):
+    cache.delete(support_cache.cache_key("notification_flush", ticket_id))
+
+    with transaction.atomic():
+        notifications = list(
+            models.PendingNotification.objects.select_for_update(skip_locked=True)
+            .filter(ticket_id=ticket_id).order_by("created")
+        )
+        if not notifications:
+            return
+
+        ticket = models.Ticket.objects.select_related("assigned_to__customer").get(id=ticket_id)
+        # publish before the rows are deleted, so a failed commit repeats a notification rather than losing it
+        dispatch_notifications(ticket, notifications)
+        models.PendingNotification.objects.filter(id__in=[n.id for n in notifications]).delete()
+
+
+@shared_task(
+    autoretry_for=(Exception,), retry_backoff=1, retry_backoff_max=60, max_retries=None, default_retry_delay=3
+)
+def send_single_notification(customer_id, title: str, message: str, timestamp: int, ticket_id: typing.Optional[str]):
+    customer = models.Customer.objects.get(id=customer_id)
+    ticket = models.Ticket.objects.get(id=ticket_id) if ticket_id else None
 
     if customer.pushover_user_key:
-        r = requests.post("https://api.pushover.net/1/messages.json", data=data)
-        r.raise_for_status()
+        send_pushover(customer.pushover_user_key, title, message, timestamp, ticket)
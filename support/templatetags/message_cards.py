@@ -0,0 +1,10 @@
+from django import template
+from django.utils.safestring import mark_safe
+from .. import timeline
+
+register = template.Library()
+
+
+@register.simple_tag
+def message_cards(messages, template_name):
+    return mark_safe(timeline.render_message_cards(messages, template_name))
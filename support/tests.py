@@ -1,3 +1,1127 @@
-from django.test import TestCase
+import base64
+import datetime
+import email.message
+import email.policy
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import smtplib
+import tempfile
+import threading
+import time
+import typing
+import cryptography.hazmat.primitives.asymmetric.padding
+import cryptography.hazmat.primitives.asymmetric.rsa
+import cryptography.hazmat.primitives.hashes
+import cryptography.hazmat.primitives.serialization
+import pgpy
+import sentry_sdk
+from unittest import mock, skipUnless
+from django.db import OperationalError
+from django.db.models import CharField, TextField
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.storage import InMemoryStorage
+from django.core.mail import EmailMessage
+from django.urls import reverse
+from django.utils import timezone
+from . import models, timeline, pagination, search, db, outbox, tasks, inbound, postal, pgp, metrics, mail
+from .views import webhooks
+from as207960_support import settings as project_settings
+from as207960_support.celery import SupportTask
 
-# Create your tests here.
+
+class PGPKeyStateTestCase(TestCase):
+    def test_key_changes_seen_by_other_instances(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.assertFalse(customer.has_pgp_keys())
+
+        other = models.Customer.objects.get(id=customer.id)
+        key = models.CustomerPGPKey.objects.create(customer=other, fingerprint="0123", pgp_key="", primary=True)
+        customer.save()
+
+        customer = models.Customer.objects.get(id=customer.id)
+        self.assertEqual(customer.primary_pgp_key(), key)
+
+        with mock.patch("django.core.cache.cache.delete") as delete:
+            key.delete()
+        delete.assert_not_called()
+        self.assertIsNone(models.Customer.objects.get(id=customer.id).primary_pgp_key())
+
+
+class MessageSanitizerTestCase(TestCase):
+    def setUp(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+
+    def add_message(self, html: str) -> models.TicketMessage:
+        return models.TicketMessage.objects.create(
+            ticket=self.ticket, type=models.TicketMessage.TYPE_CUSTOMER, date=timezone.now(), message=html
+        )
+
+    def test_sanitized_at_write(self):
+        self.add_message('<p onclick="steal()">Hi</p><script>steal()</script>')
+
+        message = models.TicketMessage.objects.get()
+        self.assertEqual(message.message_safe_version, models.HTML_SANITIZER_VERSION)
+        with mock.patch.object(models, "sanitize_html") as sanitize_html:
+            self.assertIn("Hi", message.message_safe)
+        sanitize_html.assert_not_called()
+        self.assertNotIn("script", message.message_safe)
+        self.assertNotIn("onclick", message.message_safe)
+
+    def test_stale_rows_backfilled(self):
+        message = self.add_message("<p>Hi</p><script>steal()</script>")
+        models.TicketMessage.objects.filter(id=message.id).update(
+            message_safe_html="<script>steal()</script>", message_safe_version=models.HTML_SANITIZER_VERSION - 1
+        )
+        message = models.TicketMessage.objects.get()
+        self.assertNotIn("script", message.message_safe)
+
+        call_command("sanitize-messages", stdout=io.StringIO())
+        message = models.TicketMessage.objects.get()
+        self.assertEqual(message.message_safe_version, models.HTML_SANITIZER_VERSION)
+        self.assertNotIn("script", message.message_safe_html)
+
+
+class TicketSummaryTestCase(TestCase):
+    def setUp(self):
+        self.customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.agent = get_user_model().objects.create(username="agent", first_name="Agent")
+
+    def summary(self, ticket: models.Ticket) -> tuple:
+        ticket = models.Ticket.objects.get(id=ticket.id)
+        return ticket.message_count, ticket.last_message_type, ticket.awaiting_agent
+
+    def test_summary_follows_messages(self):
+        opened = tasks.open_ticket(
+            self.customer, "Help", "<p>Help</p>", source=models.Ticket.SOURCE_EMAIL,
+            priority=models.Ticket.PRIORITY_NORMAL, verified=False
+        )
+        ticket = opened.ticket
+        self.assertEqual(self.summary(ticket), (1, models.TicketMessage.TYPE_CUSTOMER, True))
+        self.assertEqual(ticket.first_message_date, opened.date)
+
+        tasks.post_reply(ticket, "<p>Fixed</p>", self.agent)
+        self.assertEqual(self.summary(ticket), (2, models.TicketMessage.TYPE_RESPONSE, False))
+
+        tasks.post_message(ticket, "<p>Still broken</p>")
+        self.assertEqual(self.summary(ticket), (3, models.TicketMessage.TYPE_CUSTOMER, True))
+
+        tasks.post_note(ticket, "<p>Looking into it</p>")
+        self.assertEqual(self.summary(ticket), (4, models.TicketMessage.TYPE_NOTE, False))
+
+        models.TicketMessage.objects.create(
+            ticket=ticket, type=models.TicketMessage.TYPE_CUSTOMER, message="<p>Late</p>",
+            date=opened.date - datetime.timedelta(days=1)
+        )
+        ticket = models.Ticket.objects.get(id=ticket.id)
+        self.assertEqual(self.summary(ticket), (5, models.TicketMessage.TYPE_NOTE, False))
+        self.assertEqual(ticket.first_message_date, opened.date - datetime.timedelta(days=1))
+
+        expected = models.Ticket.objects.values(*models.Ticket.SUMMARY_FIELDS).get()
+        models.Ticket.objects.update(message_count=0, last_message_date=None, awaiting_agent=True)
+        call_command("rebuild-ticket-summaries", stdout=io.StringIO())
+        self.assertEqual(models.Ticket.objects.values(*models.Ticket.SUMMARY_FIELDS).get(), expected)
+
+
+class CursorPaginatorTestCase(TestCase):
+    def setUp(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        now = timezone.now()
+        dates = [now, now, now - datetime.timedelta(hours=1), None, None, now - datetime.timedelta(hours=2), None]
+        for i, date in enumerate(dates):
+            models.Ticket.objects.create(customer=customer, subject=f"Ticket {i}", last_message_date=date)
+        self.expected = sorted(
+            models.Ticket.objects.all(),
+            key=lambda t: (t.last_message_date is not None, t.last_message_date or now, str(t.pk)), reverse=True
+        )
+
+    def test_forward_and_backward_with_null_dates(self):
+        paginator = pagination.CursorPaginator(models.Ticket.objects.all(), 2)
+        pages = [paginator.get_page(None)]
+        self.assertFalse(pages[0].has_previous())
+        while pages[-1].has_next():
+            pages.append(paginator.get_page(pages[-1].next_cursor))
+        self.assertEqual([t for page in pages for t in page], self.expected)
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+
+        page = pages[-1]
+        for i in reversed(range(len(pages) - 1)):
+            self.assertTrue(page.has_previous())
+            page = paginator.get_page(page.previous_cursor)
+            self.assertEqual(page.object_list, pages[i].object_list)
+            self.assertEqual(paginator.get_page(page.next_cursor).object_list, pages[i + 1].object_list)
+        self.assertFalse(page.has_previous())
+
+        self.assertEqual(paginator.get_page("bogus").object_list, pages[0].object_list)
+
+
+class TimelineTestCase(TestCase):
+    def setUp(self):
+        self.customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.pgp_key = models.CustomerPGPKey.objects.create(
+            customer=self.customer, fingerprint="0123456789ABCDEF", pgp_key="", primary=True
+        )
+        self.ticket = models.Ticket.objects.create(customer=self.customer, subject="Test")
+        self.start = timezone.now()
+
+    def add_messages(self, count: int):
+        for i in range(count):
+            message = models.TicketMessage.objects.create(
+                ticket=self.ticket,
+                type=models.TicketMessage.TYPE_CUSTOMER if i % 2 == 0 else models.TicketMessage.TYPE_RESPONSE,
+                date=self.start + datetime.timedelta(minutes=i),
+                message=f"<p>Message {i}</p>",
+                pgp_signed_message=True,
+                pgp_signing_key=self.pgp_key,
+            )
+            models.TicketMessageAttachment.objects.create(message=message, file_name=f"file-{i}.txt", file="file.txt")
+
+    def render_timeline(self) -> timeline.Timeline:
+        ticket_timeline = timeline.load_timeline(self.ticket)
+        for message in ticket_timeline:
+            for attachment in message.ticketmessageattachment_set.all():
+                attachment.file_name
+            if message.pgp_signing_key:
+                message.pgp_signing_key.fingerprint
+            message.message_safe
+        ticket_timeline.last_customer_message
+        ticket_timeline.last_response
+        return ticket_timeline
+
+    def test_constant_query_count(self):
+        self.add_messages(1)
+        with self.assertNumQueries(3):
+            self.render_timeline()
+
+        self.add_messages(30)
+        with self.assertNumQueries(3):
+            ticket_timeline = self.render_timeline()
+
+        self.assertEqual(len(ticket_timeline), 31)
+
+    def test_header_stats(self):
+        self.add_messages(4)
+        ticket_timeline = timeline.load_timeline(self.ticket)
+        self.assertEqual(ticket_timeline.last_customer_message.date, self.start + datetime.timedelta(minutes=2))
+        self.assertEqual(ticket_timeline.last_response.date, self.start + datetime.timedelta(minutes=3))
+
+    def test_incremental_loading(self):
+        self.add_messages(12)
+        ticket_timeline = timeline.load_timeline(self.ticket, limit=5)
+        self.assertEqual(len(ticket_timeline), 6)
+        self.assertIsNotNone(ticket_timeline.earlier_cursor)
+
+        messages = list(ticket_timeline.tail)
+        cursor = ticket_timeline.earlier_cursor
+        while cursor:
+            earlier, cursor = timeline.load_earlier(self.ticket, cursor, 4)
+            messages = earlier + messages
+        messages = list(ticket_timeline.head) + messages
+
+        self.assertEqual(
+            [m.id for m in messages], list(self.ticket.messages.order_by('date').values_list('id', flat=True))
+        )
+        self.assertIsNone(timeline.load_earlier(self.ticket, "invalid", 4))
+
+    def test_message_card_versioned_by_update(self):
+        self.add_messages(1)
+        message = self.ticket.messages.get()
+        template_name = "support/admin/message_card.html"
+        with mock.patch.object(timeline, "render_to_string", return_value="card") as render:
+            timeline.render_message_cards([message], template_name)
+            timeline.render_message_cards([self.ticket.messages.get()], template_name)
+            self.assertEqual(render.call_count, 1)
+
+            models.TicketMessageAttachment.objects.create(message=message, file_name="new.txt", file="new.txt")
+            timeline.render_message_cards([self.ticket.messages.get()], template_name)
+            self.assertEqual(render.call_count, 2)
+
+            self.pgp_key.delete()
+            timeline.render_message_cards([self.ticket.messages.get()], template_name)
+            self.assertEqual(render.call_count, 3)
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        customer = models.Customer.objects.create(email="bob@example.com", full_name="Bob Smith")
+        self.transfer = models.Ticket.objects.create(customer=customer, subject="Domain transfer stuck")
+        models.TicketMessage.objects.create(
+            ticket=self.transfer, type=models.TicketMessage.TYPE_CUSTOMER, date=timezone.now(),
+            message="<p>The transfer of <b>example.com</b> is pending</p>",
+        )
+        self.invoice = models.Ticket.objects.create(
+            customer=customer, subject="Invoice", state=models.Ticket.STATE_CLOSED
+        )
+        models.TicketMessage.objects.create(
+            ticket=self.invoice, type=models.TicketMessage.TYPE_CUSTOMER, date=timezone.now(),
+            message="<p>Where is my invoice for the transfer?</p>",
+        )
+
+    def test_ranked_results(self):
+        results = search.search("transfer")
+        self.assertEqual([r.ticket for r in results], [self.transfer, self.invoice])
+        self.assertIn("<mark>transfer</mark>", results[0].snippet)
+
+    def test_ref_and_filters(self):
+        self.assertEqual([r.ticket for r in search.search(f"#{self.invoice.ref}")], [self.invoice])
+        self.assertEqual([r.ticket for r in search.search(self.invoice.ref.lower())], [self.invoice])
+        self.assertEqual({r.ticket for r in search.search("SMITH")}, {self.transfer, self.invoice})
+        self.assertEqual(
+            [r.ticket for r in search.search("transfer", {"state": models.Ticket.STATE_OPEN})], [self.transfer]
+        )
+
+    def test_ilike_not_registered_globally(self):
+        self.assertNotIn("ilike", CharField.get_lookups())
+        self.assertNotIn("ilike", TextField.get_lookups())
+
+
+def run_in_daemon(results):
+    results.put(pgp.OperationPool(2, 5).run(pow, 2, 10))
+
+
+def make_pgp_key(passphrase: str = None) -> pgpy.PGPKey:
+    key = pgpy.PGPKey.new(pgpy.constants.PubKeyAlgorithm.EdDSA, pgpy.constants.EllipticCurveOID.Ed25519)
+    key.add_uid(
+        pgpy.PGPUID.new("Support", email="support@example.com"),
+        usage={pgpy.constants.KeyFlags.Sign}, hashes=[pgpy.constants.HashAlgorithm.SHA256]
+    )
+    if passphrase:
+        key.protect(passphrase, pgpy.constants.SymmetricKeyAlgorithm.AES256, pgpy.constants.HashAlgorithm.SHA256)
+    return key
+
+
+class ServiceKeyTestCase(SimpleTestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.path = os.path.join(tmp_dir.name, "key.asc")
+        self.write_key(make_pgp_key("secret"), 1)
+        self.service_key = pgp.ServiceKey(self.path, "secret")
+        self.addCleanup(self.service_key.lock)
+
+    def write_key(self, key: pgpy.PGPKey, mtime: int):
+        with open(self.path, "w") as f:
+            f.write(str(key))
+        os.utime(self.path, ns=(mtime, mtime))
+
+    def test_unlocked_once_per_key(self):
+        with mock.patch.object(pgpy.PGPKey, "unlock", autospec=True, side_effect=pgpy.PGPKey.unlock) as unlock:
+            for _ in range(3):
+                with self.service_key.unlocked() as key:
+                    self.assertTrue(key.is_unlocked)
+                    key.sign("test")
+            self.assertEqual(unlock.call_count, 1)
+
+            self.service_key.lock()
+            self.assertFalse(self.service_key.key.is_unlocked)
+            self.assertTrue(key.is_unlocked)
+
+            self.write_key(make_pgp_key("secret"), 2)
+            with self.service_key.unlocked() as rotated:
+                self.assertNotEqual(rotated.fingerprint, key.fingerprint)
+            self.assertEqual(unlock.call_count, 2)
+
+            rotated_key = self.service_key.key
+            self.write_key(make_pgp_key("secret"), 3)
+            self.assertIsNot(self.service_key.key, rotated_key)
+            self.assertFalse(rotated_key.is_unlocked)
+
+    def test_lock_not_held_during_operation(self):
+        def sign():
+            with self.service_key.unlocked() as key:
+                signatures.append(key.sign("test"))
+
+        signatures = []
+        with self.service_key.unlocked():
+            other = threading.Thread(target=sign)
+            other.start()
+            other.join(10)
+            self.assertFalse(other.is_alive())
+        self.assertEqual(len(signatures), 1)
+
+
+class OperationPoolTestCase(SimpleTestCase):
+    def test_runs_inline_in_daemon_process(self):
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        process = context.Process(target=run_in_daemon, args=(results,), daemon=True)
+        process.start()
+        process.join(10)
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(results.get(timeout=1), 1024)
+
+    def test_timeout_kills_worker(self):
+        pool = pgp.OperationPool(1, 1)
+        self.addCleanup(pool.shutdown)
+
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            pool.run(time.sleep, 30)
+        self.assertEqual(pool.run(abs, -3), 3)
+        self.assertLess(time.monotonic() - start, 15)
+        self.assertEqual(pool.stats()["operations"]["sleep"]["timeouts"], 1)
+        self.assertEqual(metrics.registry().get_sample_value(
+            "support_pgp_operation_duration_seconds_count", {"operation": "sleep", "result": "timeouts"}
+        ), 1)
+
+
+class RetryTransactionTestCase(TransactionTestCase):
+    def restart_error(self, sqlstate: str) -> OperationalError:
+        cause = Exception()
+        cause.pgcode = sqlstate
+        error = OperationalError()
+        error.__cause__ = cause
+        return error
+
+    def test_retries_restart_errors(self):
+        attempts = []
+
+        @db.retry_transaction(attempts=3)
+        def create_customer():
+            attempts.append(True)
+            models.Customer.objects.create(email=f"{len(attempts)}@example.com", full_name="Customer")
+            if len(attempts) < 3:
+                raise self.restart_error("40001")
+
+        create_customer()
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(list(models.Customer.objects.values_list("email", flat=True)), ["3@example.com"])
+
+    def test_retried_instance_changes_not_repeated(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+        key = models.CustomerPGPKey.objects.create(customer=customer, fingerprint="0123", pgp_key="")
+        enqueue = outbox.enqueue
+        attempts = []
+
+        def flaky_enqueue(*args, **kwargs):
+            attempts.append(True)
+            if len(attempts) == 1:
+                raise self.restart_error("40001")
+            return enqueue(*args, **kwargs)
+
+        with mock.patch.object(outbox, "enqueue", flaky_enqueue):
+            tasks.post_message(ticket, "<p>Hello</p>")
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual(ticket.message_count, 1)
+        ticket.save()
+        self.assertEqual(models.Ticket.objects.get(id=ticket.id).message_count, 1)
+
+        stale = models.CustomerPGPKey.objects.get(id=key.id)
+        key.save()
+        stale.save()
+        self.assertEqual((key.version, stale.version), (2, 3))
+
+    def test_other_errors_not_retried(self):
+        attempts = []
+
+        @db.retry_transaction(attempts=3)
+        def fail():
+            attempts.append(True)
+            raise self.restart_error("57P01")
+
+        with self.assertRaises(OperationalError):
+            fail()
+        self.assertEqual(len(attempts), 1)
+
+
+class OutboxTestCase(TestCase):
+    def setUp(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+
+    def test_enqueue_and_dispatch(self):
+        tasks.close_ticket(self.ticket)
+        message = models.OutboxMessage.objects.get()
+        self.assertEqual(message.task, tasks.send_close_ticket_email.name)
+        self.assertIsNone(outbox.enqueue(tasks.send_close_ticket_email, self.ticket.id, dedup_key=message.dedup_key))
+
+        app = mock.MagicMock()
+        with mock.patch("celery.current_app", app):
+            self.assertEqual(outbox.dispatch_pending(), 1)
+            self.assertEqual(outbox.dispatch_pending(), 0)
+
+        app.tasks[message.task].apply_async.assert_called_once_with(
+            args=[str(self.ticket.id)], task_id=str(message.id), priority=self.ticket.task_priority
+        )
+        self.assertIsNotNone(models.OutboxMessage.objects.get().dispatched)
+
+    @override_settings(OUTBOX_MAX_ATTEMPTS=3, OUTBOX_RETRY_BACKOFF=10, OUTBOX_RETRY_BACKOFF_MAX=15)
+    def test_failed_dispatch_backs_off_and_dead_letters(self):
+        failing = outbox.enqueue("support.tasks.failing")
+        ok = outbox.enqueue("support.tasks.ok")
+
+        app = mock.MagicMock()
+        app.tasks = {"support.tasks.failing": mock.MagicMock(), "support.tasks.ok": mock.MagicMock()}
+        app.tasks["support.tasks.failing"].apply_async.side_effect = ConnectionError("broker down")
+        start = timezone.now()
+        with mock.patch("celery.current_app", app):
+            self.assertEqual(outbox.dispatch_pending(), 1)
+            failing.refresh_from_db()
+            self.assertEqual(failing.attempts, 1)
+            self.assertGreaterEqual(failing.next_attempt_at, start + datetime.timedelta(seconds=10))
+            self.assertIsNotNone(models.OutboxMessage.objects.get(id=ok.id).dispatched)
+
+            self.assertEqual(outbox.dispatch_pending(), 0)
+            self.assertEqual(app.tasks["support.tasks.failing"].apply_async.call_count, 1)
+
+            for attempts, delay in ((2, 15), (3, 15)):
+                models.OutboxMessage.objects.filter(id=failing.id).update(next_attempt_at=timezone.now())
+                start = timezone.now()
+                outbox.dispatch_pending()
+                failing.refresh_from_db()
+                self.assertEqual(failing.attempts, attempts)
+                self.assertGreaterEqual(failing.next_attempt_at, start + datetime.timedelta(seconds=delay))
+
+            self.assertIsNotNone(failing.dead_lettered)
+            models.OutboxMessage.objects.filter(id=failing.id).update(next_attempt_at=timezone.now())
+            outbox.dispatch_pending()
+            self.assertEqual(app.tasks["support.tasks.failing"].apply_async.call_count, 3)
+
+        self.assertEqual(outbox.requeue_dead_letters(), 1)
+        failing.refresh_from_db()
+        self.assertEqual((failing.attempts, failing.dead_lettered), (0, None))
+
+
+class TracePropagationTestCase(TestCase):
+    def test_outbox_continues_request_trace(self):
+        with sentry_sdk.start_transaction(name="request", sampled=False) as transaction:
+            message = outbox.enqueue("support.tasks.traced")
+        self.assertTrue(message.trace_headers["sentry-trace"].startswith(transaction.trace_id))
+
+        published = []
+        app = mock.MagicMock()
+        app.tasks = {"support.tasks.traced": mock.Mock()}
+        app.tasks["support.tasks.traced"].apply_async.side_effect = lambda **_kwargs: published.append(
+            sentry_sdk.get_traceparent()
+        )
+        with mock.patch("celery.current_app", app):
+            outbox.dispatch_pending()
+        self.assertEqual(len(published), 1)
+        self.assertTrue(published[0].startswith(transaction.trace_id))
+
+    def test_sampler(self):
+        with mock.patch.object(project_settings, "SENTRY_TRACES_SAMPLE_RATE", 0.25):
+            self.assertEqual(project_settings.sentry_traces_sampler({"parent_sampled": True}), True)
+            self.assertEqual(project_settings.sentry_traces_sampler({"parent_sampled": False}), False)
+            self.assertEqual(project_settings.sentry_traces_sampler({"wsgi_environ": {"PATH_INFO": "/metrics/"}}), 0)
+            self.assertEqual(project_settings.sentry_traces_sampler({"wsgi_environ": {"PATH_INFO": "/"}}), 0.25)
+
+
+class SupportTaskTestCase(SimpleTestCase):
+    @override_settings(TASK_RETRY_DEMOTE_AFTER=3)
+    def test_retry_demoted_to_bulk(self):
+        task = tasks.send_close_ticket_email._get_current_object()
+        self.assertIsInstance(task, SupportTask)
+
+        with mock.patch("celery.Task.retry") as retry:
+            for retries in (0, 2):
+                task.push_request(retries=retries)
+                try:
+                    task.retry(countdown=5)
+                finally:
+                    task.pop_request()
+
+        self.assertEqual(retry.call_args_list, [
+            mock.call(countdown=5),
+            mock.call(countdown=5, queue="bulk", priority=0),
+        ])
+
+
+@override_settings(NOTIFICATION_COALESCE_WINDOW=30)
+class NotificationCoalescingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        for i in range(2):
+            models.Customer.objects.create(
+                email=f"agent{i}@example.com", full_name="Agent", is_agent=True, pushover_user_key=f"key{i}"
+            )
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+
+    def test_digest(self):
+        with mock.patch.object(tasks.flush_notifications, "apply_async") as apply_async:
+            tasks.send_notification(self.ticket.id, "First", "one", 1)
+            tasks.send_notification(self.ticket.id, "Second", "two", 2)
+        apply_async.assert_called_once()
+        self.assertFalse(models.OutboxMessage.objects.exists())
+
+        with mock.patch.object(tasks.send_pushover_notification, "apply_async") as apply_async:
+            tasks.flush_notifications(self.ticket.id)
+        self.assertFalse(models.PendingNotification.objects.exists())
+        self.assertFalse(models.OutboxMessage.objects.exists())
+        sends = [c.args[0] for c in apply_async.call_args_list]
+        self.assertEqual(sorted(args[0] for args in sends), ["key0", "key1"])
+        for args in sends:
+            self.assertEqual(args[1:4], (f"2 updates on ticket #{self.ticket.ref}", "First\none\n\nSecond\ntwo", 2))
+
+    def test_emergency_not_coalesced(self):
+        self.ticket.priority = models.Ticket.PRIORITY_EMERGENCY
+        self.ticket.save()
+        with mock.patch.object(tasks.flush_notifications, "apply_async") as apply_async, \
+                mock.patch.object(tasks.send_pushover_notification, "apply_async") as send:
+            tasks.send_notification(self.ticket.id, "Urgent", "now", 1)
+        apply_async.assert_not_called()
+        self.assertFalse(models.PendingNotification.objects.exists())
+        self.assertEqual(send.call_count, 2)
+
+
+class StripeWebhookTestCase(TestCase):
+    def test_notification_queued_with_message(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+        models.VerificationSession.objects.create(ticket=ticket, stripe_session="vs_1")
+        event = {"type": "identity.verification_session.requires_input", "data": {"object": {"id": "vs_1"}}}
+
+        with mock.patch("stripe.Webhook.construct_event", return_value=event), \
+                mock.patch.object(tasks.send_notification, "delay") as delay:
+            response = self.client.post(reverse(webhooks.stripe_webhook), b"{}", content_type="application/json")
+        self.assertEqual(response.status_code, 204)
+        delay.assert_not_called()
+
+        ticket_message = models.TicketMessage.objects.get(ticket=ticket)
+        notification = models.OutboxMessage.objects.get(task=tasks.send_notification.name)
+        self.assertEqual(notification.dedup_key, f"notification:{ticket_message.id}")
+        self.assertEqual(notification.args[:2], [str(ticket.id), "Verification failed"])
+
+
+class MetricsTestCase(TestCase):
+    @override_settings(METRICS_TOKEN="token")
+    def test_metrics_endpoint(self):
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 401)
+        self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer token")
+
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer token")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(
+            b'support_http_request_duration_seconds_count{method="GET",status="200",view="metrics"}',
+            response.content
+        )
+
+    @override_settings(METRICS_TOKEN="token")
+    def test_unknown_methods_grouped(self):
+        def sample(method: str) -> float:
+            return metrics.registry().get_sample_value(
+                "support_http_request_duration_seconds_count", {"method": method, "status": "401", "view": "metrics"}
+            ) or 0
+
+        before = sample("other")
+        self.client.generic("PROPFIND", reverse("metrics"))
+        self.client.generic("X-RANDOM-1", reverse("metrics"))
+        self.assertEqual(sample("other") - before, 2)
+        self.assertEqual(sample("X-RANDOM-1"), 0)
+
+    def test_cache_requests_exported(self):
+        def sample(result: str) -> float:
+            return metrics.registry().get_sample_value(
+                "support_cache_requests_total", {"cache": "default", "result": result}
+            ) or 0
+
+        hits, misses = sample("hit"), sample("miss")
+        cache.set("metrics-test", 1)
+        cache.get("metrics-test")
+        cache.get_many(["metrics-test", "metrics-test-missing"])
+        self.assertEqual((sample("hit") - hits, sample("miss") - misses), (2, 1))
+
+
+class AttachmentUploadTestCase(TestCase):
+    def setUp(self):
+        self.saved = {}
+        self.failing = set()
+        self.storage = mock.Mock()
+        self.storage.save.side_effect = self.save
+        self.storage.delete.side_effect = lambda name: self.saved.pop(name, None)
+        patcher = mock.patch.object(models.AttachmentBlob.file.field, "storage", self.storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save(self, name, content, max_length=None):
+        data = content.read()
+        if data in self.failing:
+            raise IOError(name)
+        self.saved[name] = data
+        return name
+
+    def make_attachments(self, *contents: bytes):
+        return [{
+            "file_name": "file.txt", "file_ext": ".txt", "content_id": None, "content": io.BytesIO(content),
+            "sha256": hashlib.sha256(content).hexdigest(), "size": len(content),
+        } for content in contents]
+
+    @override_settings(ATTACHMENT_SPOOL_MAX_SIZE=1024)
+    def test_streaming_decode(self):
+        data = bytes(range(256)) * 1024
+        for encoding in ("base64", "quoted-printable"):
+            part = email.message.EmailMessage()
+            part.set_content(data, "application", "octet-stream", cte=encoding)
+            with mock.patch.object(inbound, "DECODE_CHUNK_SIZE", 1000):
+                content, sha256, size = inbound.spool_attachment(part)
+            with content:
+                self.assertTrue(content._rolled)
+                self.assertEqual(content.read(), data)
+            self.assertEqual((sha256, size), (hashlib.sha256(data).hexdigest(), len(data)))
+
+    def test_concurrent_upload(self):
+        attachments = self.make_attachments(*(f"data-{i}".encode() for i in range(5)))
+        uploaded = inbound.upload_attachments(attachments)
+        self.assertEqual(len(uploaded), 5)
+        self.assertEqual(sorted(self.saved.values()), [f"data-{i}".encode() for i in range(5)])
+        self.assertTrue(all("content" not in a for a in attachments))
+
+    def test_failed_upload_cleans_up(self):
+        self.failing = {b"data-1", b"data-3"}
+        attachments = self.make_attachments(*(f"data-{i}".encode() for i in range(5)))
+        with self.assertRaises(ExceptionGroup) as cm:
+            inbound.upload_attachments(attachments)
+        self.assertEqual(len(cm.exception.exceptions), 2)
+        self.assertEqual(self.saved, {})
+
+    def test_deduplicated_blobs(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+
+        def ingest(*contents: bytes):
+            attachments = self.make_attachments(*contents)
+            uploaded = inbound.upload_attachments(attachments)
+            message = models.TicketMessage.objects.create(
+                ticket=ticket, type=models.TicketMessage.TYPE_CUSTOMER, date=timezone.now(), message="<p>Hi</p>"
+            )
+            with self.captureOnCommitCallbacks(execute=True):
+                blobs = inbound.link_attachment_blobs(attachments, uploaded)
+            for attachment in attachments:
+                models.TicketMessageAttachment.objects.create(
+                    message=message, file_name=attachment["file_name"], blob=blobs[attachment["sha256"]],
+                    file=blobs[attachment["sha256"]].file.name
+                )
+            return message
+
+        first = ingest(b"logo", b"logo", b"report")
+        second = ingest(b"logo")
+        self.assertEqual(self.storage.save.call_count, 2)
+        self.assertEqual(models.AttachmentBlob.objects.get(sha256=hashlib.sha256(b"logo").hexdigest()).ref_count, 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertEqual(list(self.saved.values()), [b"logo"])
+        self.assertEqual(models.AttachmentBlob.objects.get().ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertEqual(self.saved, {})
+        self.assertFalse(models.AttachmentBlob.objects.exists())
+
+    def test_cid_urls_use_winning_blob(self):
+        self.storage.url.side_effect = lambda name: f"https://files.example.com/{name}"
+        msg = email.message.EmailMessage()
+        msg["From"] = "customer@example.com"
+        msg["Date"] = "Mon, 1 Jan 2024 00:00:00 +0000"
+        msg["Message-ID"] = "<cid-race@example.com>"
+        msg["Subject"] = "Logo"
+        msg.set_content('<p><img src="cid:logo@example.com"></p>', subtype="html")
+        msg.add_attachment(b"logo", "image", "png", filename="logo.png", cid="<logo@example.com>")
+
+        upload_attachments = inbound.upload_attachments
+
+        def race(attachments):
+            uploaded = upload_attachments(attachments)
+            models.AttachmentBlob.objects.create(
+                sha256=hashlib.sha256(b"logo").hexdigest(), file="attachments/winner.png", size=4
+            )
+            return uploaded
+
+        with mock.patch.object(inbound, "upload_attachments", race), \
+                self.captureOnCommitCallbacks(execute=True):
+            inbound.process_email(msg.as_bytes())
+
+        message = models.TicketMessage.objects.get()
+        self.assertIn("https://files.example.com/attachments/winner.png", message.message)
+        self.assertEqual(message.ticketmessageattachment_set.get().file.name, "attachments/winner.png")
+        self.assertEqual(self.saved, {})
+
+
+def make_email(message_id: str, body: str = "Hello", **headers) -> bytes:
+    msg = email.message.EmailMessage()
+    msg["From"] = "customer@example.com"
+    msg["To"] = "support@example.com"
+    msg["Subject"] = "Help"
+    msg["Date"] = "Mon, 1 Jan 2024 00:00:00 +0000"
+    msg["Message-ID"] = message_id
+    for header, value in headers.items():
+        msg[header.replace("_", "-")] = value
+    msg.set_content(body)
+    return msg.as_bytes()
+
+
+def make_signed_email(
+        message_id: str, signer: pgpy.PGPKey, attach_keys: typing.List[pgpy.PGPKey] = (), signed_text: str = None
+) -> bytes:
+    if signed_text is None:
+        inner = email.message.EmailMessage()
+        inner.set_content("Signed hello")
+        for i, key in enumerate(attach_keys):
+            inner.add_attachment(str(key.pubkey).encode(), "application", "pgp-keys", filename=f"key-{i}.asc")
+        signed_text = inner.as_bytes(policy=email.policy.SMTP).decode()
+    signature = signer.sign(signed_text)
+
+    return "\r\n".join([
+        "From: customer@example.com",
+        "To: support@example.com",
+        "Subject: Signed",
+        "Date: Mon, 1 Jan 2024 00:00:00 +0000",
+        f"Message-ID: {message_id}",
+        "MIME-Version: 1.0",
+        'Content-Type: multipart/signed; protocol="application/pgp-signature"; micalg=pgp-sha256; boundary="sig"',
+        "",
+        "--sig",
+        signed_text,
+        "--sig",
+        "Content-Type: application/pgp-signature",
+        "",
+        str(signature),
+        "--sig--",
+        "",
+    ]).encode()
+
+
+class SignerKeySelectionTestCase(TestCase):
+    def setUp(self):
+        self.decoy = make_pgp_key()
+        self.signer = make_pgp_key()
+
+    def process(self, msg: bytes) -> models.TicketMessage:
+        with mock.patch.object(pgp, "verify", wraps=pgp.verify) as verify, \
+                self.captureOnCommitCallbacks(execute=True):
+            inbound.process_email(msg)
+        self.assertEqual(verify.call_count, 1)
+        self.assertEqual(verify.call_args.args[0][0], str(self.signer.fingerprint))
+        return models.TicketMessage.objects.get()
+
+    def test_attached_key_selected_by_issuer(self):
+        message = self.process(make_signed_email("<signed@example.com>", self.signer, [self.decoy, self.signer]))
+        self.assertTrue(message.pgp_signed_message)
+        self.assertEqual(message.pgp_signing_key.fingerprint, str(self.signer.fingerprint))
+        self.assertEqual(models.CustomerPGPKey.objects.count(), 2)
+
+    def test_8bit_signed_part_verified_as_sent(self):
+        signed_text = "\r\n".join([
+            'Content-Type: multipart/mixed; boundary="inner"',
+            "",
+            "--inner",
+            "Content-Type: text/plain; charset=utf-8",
+            "Content-Transfer-Encoding: 8bit",
+            "",
+            "Signed h\u00e9llo",
+            "--inner",
+            'Content-Type: application/pgp-keys; name="key.asc"',
+            "Content-Disposition: attachment",
+            "",
+            str(self.signer.pubkey).replace("\n", "\r\n"),
+            "--inner--",
+            "",
+        ])
+        message = self.process(make_signed_email("<signed@example.com>", self.signer, signed_text=signed_text))
+        self.assertEqual(message.pgp_signing_key.fingerprint, str(self.signer.fingerprint))
+
+    @skipUnless(models.has_full_text_search(), "array lookups need PostgreSQL or CockroachDB")
+    def test_stored_key_selected_by_issuer(self):
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        for i, key in enumerate((self.decoy, self.signer)):
+            models.CustomerPGPKey.objects.create(
+                customer=customer, fingerprint=str(key.fingerprint), pgp_key=str(key.pubkey),
+                key_ids=pgp.key_ids(key), primary=i == 0
+            )
+
+        message = self.process(make_signed_email("<signed@example.com>", self.signer))
+        self.assertEqual(message.pgp_signing_key.fingerprint, str(self.signer.fingerprint))
+
+
+class MessageIDThreadingTestCase(TestCase):
+    def process(self, msg: bytes):
+        with self.captureOnCommitCallbacks(execute=True):
+            inbound.process_email(msg)
+
+    def test_replies_threaded_and_duplicates_dropped(self):
+        self.process(make_email("<first@example.com>"))
+        ticket = models.Ticket.objects.get()
+
+        self.process(make_email("<second@example.com>", "Reply", In_Reply_To="<first@example.com>"))
+        self.process(make_email("<third@example.com>", "Reply", References="<unknown@example.com> <second@example.com>"))
+        self.process(make_email("<second@example.com>", "Reply", In_Reply_To="<first@example.com>"))
+
+        self.assertEqual(models.Ticket.objects.count(), 1)
+        self.assertEqual(ticket.messages.count(), 3)
+        self.assertEqual(
+            models.EmailMessageID.objects.filter(ticket=ticket, message__isnull=False).count(), 3
+        )
+
+    def test_claim_released_when_nothing_stored(self):
+        models.Customer.objects.create(email="customer@example.com", full_name="Customer", emails_blocked=True)
+        with mock.patch.object(tasks.send_email_blocked, "delay") as send_email_blocked:
+            self.process(make_email("<blocked@example.com>"))
+        send_email_blocked.assert_called_once()
+        self.assertFalse(models.EmailMessageID.objects.exists())
+
+        models.Customer.objects.update(emails_blocked=False)
+        self.process(make_email("<blocked@example.com>"))
+        self.assertEqual(models.Ticket.objects.get().messages.get().email_message_id, "<blocked@example.com>")
+
+
+class FakeSMTP:
+    instances = []
+    fail_connect = False
+
+    def __init__(self, host, port, **kwargs):
+        if FakeSMTP.fail_connect:
+            raise ConnectionRefusedError(host)
+        self.sock = object()
+        self.sent = []
+        FakeSMTP.instances.append(self)
+
+    def sendmail(self, from_email, recipients, message):
+        if self.sock is None:
+            raise smtplib.SMTPServerDisconnected("please run connect() first")
+        self.sent.append(recipients)
+
+    def noop(self):
+        return (250, b"OK") if self.sock else (421, b"closed")
+
+    def drop(self):
+        self.sock = None
+
+    def quit(self):
+        self.close()
+
+    def close(self):
+        self.sock = None
+
+
+@override_settings(EMAIL_HOST="smtp.example.com", EMAIL_PORT=25, SMTP_POOL_HEALTH_CHECK_INTERVAL=60)
+class PooledEmailBackendTestCase(SimpleTestCase):
+    def setUp(self):
+        FakeSMTP.instances = []
+        FakeSMTP.fail_connect = False
+        for patcher in (
+            mock.patch.object(mail, "pool", mail.SMTPConnectionPool(2, 60)),
+            mock.patch("smtplib.SMTP", FakeSMTP),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def send(self, to: str, fail_silently: bool = False) -> int:
+        message = EmailMessage("Test", "Body", "support@example.com", [to])
+        return mail.PooledEmailBackend(fail_silently=fail_silently).send_messages([message])
+
+    def test_connection_reused(self):
+        self.assertEqual(self.send("a@example.com"), 1)
+        self.assertEqual(self.send("b@example.com"), 1)
+        self.assertEqual(len(FakeSMTP.instances), 1)
+        self.assertEqual(FakeSMTP.instances[0].sent, [["a@example.com"], ["b@example.com"]])
+
+    def test_reconnects_after_drop(self):
+        for fail_silently in (False, True):
+            with self.subTest(fail_silently=fail_silently):
+                mail.pool.clear()
+                FakeSMTP.instances = []
+                self.assertEqual(self.send("a@example.com", fail_silently), 1)
+                FakeSMTP.instances[-1].drop()
+
+                self.assertEqual(self.send("b@example.com", fail_silently), 1)
+                self.assertEqual(len(FakeSMTP.instances), 2)
+                self.assertEqual(FakeSMTP.instances[-1].sent, [["b@example.com"]])
+
+    def test_failed_reconnect(self):
+        self.assertEqual(self.send("a@example.com"), 1)
+        FakeSMTP.instances[0].drop()
+        FakeSMTP.fail_connect = True
+
+        self.assertEqual(self.send("b@example.com", fail_silently=True), 0)
+        self.assertIsNone(mail.pool.acquire(mail.PooledEmailBackend().pool_key))
+        with self.assertRaises(ConnectionRefusedError):
+            self.send("c@example.com")
+
+
+class AttachmentCommitTestCase(TransactionTestCase):
+    def test_failed_cleanup_after_commit_keeps_linked_files(self):
+        storage = InMemoryStorage()
+        patcher = mock.patch.object(models.AttachmentBlob.file.field, "storage", storage)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        msg = email.message.EmailMessage()
+        msg["From"] = "customer@example.com"
+        msg["Date"] = "Mon, 1 Jan 2024 00:00:00 +0000"
+        msg["Message-ID"] = "<cleanup@example.com>"
+        msg.set_content("Files attached")
+        msg.add_attachment(b"logo", "image", "png", filename="logo.png")
+        msg.add_attachment(b"report", "text", "plain", filename="report.txt")
+
+        upload_attachments = inbound.upload_attachments
+
+        def race(attachments):
+            uploaded = upload_attachments(attachments)
+            models.AttachmentBlob.objects.create(
+                sha256=hashlib.sha256(b"logo").hexdigest(), file=storage.save("winner.png", io.BytesIO(b"logo")),
+                size=4
+            )
+            return uploaded
+
+        def delete(name):
+            if name.endswith(".png"):
+                raise IOError(name)
+            storage_delete(name)
+
+        storage_delete = storage.delete
+        with mock.patch.object(inbound, "upload_attachments", race), \
+                mock.patch.object(storage, "delete", side_effect=delete) as delete_mock:
+            inbound.process_email(msg.as_bytes())
+
+        delete_mock.assert_called_once()
+        attachments = models.TicketMessage.objects.get().ticketmessageattachment_set.all()
+        self.assertEqual(len(attachments), 2)
+        for attachment in attachments:
+            self.assertTrue(storage.exists(attachment.file.name))
+
+
+class DedupeAttachmentsTestCase(TestCase):
+    def setUp(self):
+        self.storage = InMemoryStorage(base_url="https://files.example.com/")
+        for field in (models.AttachmentBlob.file.field, models.TicketMessageAttachment.file.field):
+            patcher = mock.patch.object(field, "storage", self.storage)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        customer = models.Customer.objects.create(email="customer@example.com", full_name="Customer")
+        self.ticket = models.Ticket.objects.create(customer=customer, subject="Test")
+
+    def add_legacy_message(self, name: str) -> models.TicketMessage:
+        name = self.storage.save(name, io.BytesIO(b"logo"))
+        message = models.TicketMessage.objects.create(
+            ticket=self.ticket, type=models.TicketMessage.TYPE_CUSTOMER, date=timezone.now(),
+            message=f'<p>Hi</p><img src="{self.storage.url(name)}">'
+        )
+        models.TicketMessageAttachment.objects.create(message=message, file_name="logo.png", file=name)
+        return message
+
+    def dedupe(self, *args):
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("dedupe-attachments", *args, stdout=io.StringIO())
+
+    def test_legacy_cid_images_kept(self):
+        self.add_legacy_message("first.png")
+        second = self.add_legacy_message("second.png")
+
+        self.dedupe()
+        self.assertEqual(models.AttachmentBlob.objects.get().ref_count, 2)
+        self.assertTrue(self.storage.exists("second.png"))
+        self.assertIn("https://files.example.com/second.png", models.TicketMessage.objects.get(id=second.id).message)
+
+    def test_legacy_cid_images_rewritten_before_delete(self):
+        self.add_legacy_message("first.png")
+        self.dedupe()
+        second = self.add_legacy_message("second.png")
+        quoted = self.add_legacy_message("third.png")
+        models.TicketMessage.objects.filter(id=quoted.id).update(
+            message='<blockquote><img src="https://files.example.com/third.png"></blockquote>'
+        )
+        models.TicketMessage.objects.create(
+            ticket=self.ticket, type=models.TicketMessage.TYPE_RESPONSE, date=timezone.now(),
+            message='<blockquote><img src="https://files.example.com/third.png"></blockquote>'
+        )
+
+        self.dedupe("--delete-legacy-files")
+        second = models.TicketMessage.objects.get(id=second.id)
+        self.assertIn("https://files.example.com/first.png", second.message)
+        self.assertIn("https://files.example.com/first.png", second.message_safe)
+        self.assertFalse(self.storage.exists("second.png"))
+        self.assertTrue(self.storage.exists("third.png"))
+        self.assertEqual(models.AttachmentBlob.objects.get().ref_count, 3)
+
+
+class PostalWebhookTestCase(TestCase):
+    def setUp(self):
+        self.key = cryptography.hazmat.primitives.asymmetric.rsa.generate_private_key(65537, 2048)
+        public_key = self.key.public_key().public_bytes(
+            cryptography.hazmat.primitives.serialization.Encoding.DER,
+            cryptography.hazmat.primitives.serialization.PublicFormat.SubjectPublicKeyInfo
+        )
+        patcher = override_settings(POSTAL_PUBLIC_KEY=base64.b64encode(public_key).decode(), POSTAL_WEBHOOK_ASYNC=True)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        patcher = mock.patch.object(models.InboundEmail.message_file.field, "storage", InMemoryStorage())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, body: bytes, signature: bytes = None):
+        if signature is None:
+            signature = self.key.sign(
+                body, cryptography.hazmat.primitives.asymmetric.padding.PKCS1v15(),
+                cryptography.hazmat.primitives.hashes.SHA1()
+            )
+        return self.client.post(
+            reverse(webhooks.postal_webhook), body, content_type="application/json",
+            HTTP_X_POSTAL_SIGNATURE=base64.b64encode(signature).decode()
+        )
+
+    def test_streamed_payload(self):
+        message = b"From: customer@example.com\r\nSubject: Test\r\n\r\n" + bytes(range(256)) * 64
+        body = json.dumps({
+            "id": 1, "rcpt_to": "support@example.com", "mail_from": "customer@example.com",
+            "message": base64.encodebytes(message).decode(), "base64": True,
+        }).replace("/", "\\/").encode()
+
+        with mock.patch.object(postal, "CHUNK_SIZE", 100):
+            self.assertEqual(self.post(body).status_code, 202)
+        inbound_email = models.InboundEmail.objects.get()
+        self.assertIsNone(inbound_email.message)
+        self.assertEqual(b"".join(inbound_email.message_chunks()), message)
+        self.assertEqual(inbound_email.rcpt_to, "support@example.com")
+
+        self.assertEqual(self.post(body, signature=b"invalid").status_code, 401)
+        self.assertEqual(self.post(body[:-1]).status_code, 400)
+
+    def test_surrogate_pair_escape(self):
+        body = json.dumps({
+            "id": 1, "rcpt_to": "support@example.com", "mail_from": "\U0001F600@example.com",
+            "message": "From: customer@example.com\r\n\r\nTest", "base64": False,
+        }).encode()
+        self.assertIn(b"\\ud83d\\ude00", body)
+
+        with mock.patch.object(postal, "CHUNK_SIZE", 7):
+            self.assertEqual(self.post(body).status_code, 202)
+        self.assertEqual(models.InboundEmail.objects.get().mail_from, "\U0001F600@example.com")
+
+    def test_acknowledged_before_processing(self):
+        message = (
+            b"From: customer@example.com\r\nTo: support@example.com\r\nSubject: Help\r\n"
+            b"Date: Mon, 1 Jan 2024 00:00:00 +0000\r\nMessage-ID: <async@example.com>\r\n\r\nHello"
+        )
+        body = json.dumps({
+            "id": 1, "rcpt_to": "support@example.com", "mail_from": "customer@example.com",
+            "message": base64.b64encode(message).decode(), "base64": True,
+        }).encode()
+
+        self.assertEqual(self.post(body).status_code, 202)
+        inbound_email = models.InboundEmail.objects.get()
+        queued = models.OutboxMessage.objects.get()
+        self.assertEqual((queued.task, queued.args), (inbound.process_inbound_email.name, [str(inbound_email.id)]))
+        self.assertFalse(models.Ticket.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            inbound.process_inbound_email.apply((inbound_email.id,))
+            inbound.process_inbound_email.apply((inbound_email.id,))
+        inbound_email.refresh_from_db()
+        self.assertEqual(inbound_email.state, models.InboundEmail.STATE_PROCESSED)
+        self.assertEqual(models.Ticket.objects.get().subject, "Help")
+        self.assertEqual(models.TicketMessage.objects.count(), 1)
+
+        stored_name = inbound_email.message_file.name
+        self.assertEqual(inbound.purge_processed_inbound_emails(), 0)
+        models.InboundEmail.objects.update(processed=timezone.now() - datetime.timedelta(days=31))
+        self.assertEqual(inbound.purge_processed_inbound_emails(), 1)
+        self.assertFalse(models.InboundEmail.objects.exists())
+        self.assertFalse(models.InboundEmail.message_file.field.storage.exists(stored_name))
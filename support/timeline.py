@@ -0,0 +1,123 @@
+from django.core import signing
+from django.core.cache import caches
+from django.db.models import Prefetch, Q, prefetch_related_objects
+from django.template.loader import render_to_string
+import datetime
+import typing
+from . import models
+
+MESSAGE_PREFETCHES = (
+    'ticketmessageattachment_set',
+    Prefetch('pgp_signing_key', queryset=models.CustomerPGPKey.objects.only('id', 'fingerprint')),
+)
+
+
+class Timeline:
+    def __init__(
+            self, ticket: models.Ticket, messages: typing.List[models.TicketMessage],
+            earlier_cursor: typing.Optional[str] = None
+    ):
+        self.ticket = ticket
+        self.messages = messages
+        self.head = messages[:1]
+        self.tail = messages[1:]
+        self.earlier_cursor = earlier_cursor
+        self.last_customer_message = self._last_of_type(models.TicketMessage.TYPE_CUSTOMER)
+        self.last_response = self._last_of_type(models.TicketMessage.TYPE_RESPONSE)
+
+    def __iter__(self):
+        return iter(self.messages)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def _last_of_type(self, message_type: str) -> typing.Optional[models.TicketMessage]:
+        for message in reversed(self.messages):
+            if message.type == message_type:
+                return message
+        if self.earlier_cursor:
+            return self.ticket.messages.filter(type=message_type).order_by('-date', '-id').first()
+        return None
+
+
+def make_cursor(message: models.TicketMessage, first_message_id) -> str:
+    return signing.dumps({
+        "d": message.date.isoformat(),
+        "i": str(message.id),
+        "f": str(first_message_id),
+    }, salt="support.timeline")
+
+
+def parse_cursor(cursor: str):
+    try:
+        data = signing.loads(cursor, salt="support.timeline")
+        return datetime.datetime.fromisoformat(data["d"]), data["i"], data["f"]
+    except (signing.BadSignature, KeyError, TypeError, ValueError):
+        return None
+
+
+def ticket_messages(ticket: models.Ticket, types: typing.Optional[typing.Iterable[str]] = None, prefetch: bool = True):
+    messages = ticket.messages.all()
+    if prefetch:
+        messages = messages.prefetch_related(*MESSAGE_PREFETCHES)
+    if types is not None:
+        messages = messages.filter(type__in=types)
+    return messages
+
+
+def load_timeline(
+        ticket: models.Ticket, types: typing.Optional[typing.Iterable[str]] = None, prefetch: bool = True,
+        limit: typing.Optional[int] = None
+) -> Timeline:
+    messages = ticket_messages(ticket, types, prefetch)
+    if limit is None:
+        return Timeline(ticket, list(messages.order_by('date', 'id')))
+
+    recent = list(messages.order_by('-date', '-id')[:limit + 2])
+    recent.reverse()
+    if len(recent) <= limit + 1:
+        return Timeline(ticket, recent)
+
+    recent = recent[-limit:]
+    first_message = messages.order_by('date', 'id').first()
+    return Timeline(ticket, [first_message] + recent, earlier_cursor=make_cursor(recent[0], first_message.id))
+
+
+def load_earlier(
+        ticket: models.Ticket, cursor: str, limit: int, types: typing.Optional[typing.Iterable[str]] = None,
+        prefetch: bool = True
+) -> typing.Optional[typing.Tuple[typing.List[models.TicketMessage], typing.Optional[str]]]:
+    position = parse_cursor(cursor)
+    if not position:
+        return None
+    date, message_id, first_message_id = position
+
+    messages = ticket_messages(ticket, types, prefetch) \
+        .filter(Q(date__lt=date) | Q(date=date, id__lt=message_id)) \
+        .exclude(id=first_message_id) \
+        .order_by('-date', '-id')
+    earlier = list(messages[:limit + 1])
+    has_more = len(earlier) > limit
+    earlier = earlier[:limit]
+    earlier.reverse()
+
+    return earlier, make_cursor(earlier[0], first_message_id) if has_more else None
+
+
+def render_message_cards(messages: typing.Iterable[models.TicketMessage], template_name: str) -> str:
+    fragment_cache = caches["fragments"]
+    messages = {models.message_card_cache_key(template_name, message): message for message in messages}
+    cards = fragment_cache.get_many(list(messages.keys()))
+
+    missing = [message for key, message in messages.items() if key not in cards]
+    if missing:
+        prefetch_related_objects(missing, *MESSAGE_PREFETCHES)
+        rendered = {
+            models.message_card_cache_key(template_name, message): render_to_string(template_name, {
+                "message": message
+            }) for message in missing
+        }
+        fragment_cache.set_many(rendered)
+        cards.update(rendered)
+
+    return "".join(cards[key] for key in messages.keys())
@@ -1 +1 @@
-from . import views, admin, webhooks
+from . import views, admin, webhooks, metrics
@@ -1,26 +1,22 @@
 from django.shortcuts import render, get_object_or_404, redirect
+from django.http import HttpResponseBadRequest, JsonResponse
+from django.conf import settings
 from django.utils import timezone
-from .. import forms, models, tasks
-from django.db.models import OuterRef, Subquery, Q
-from django.core.paginator import Paginator
+import datetime
+import os
+from .. import forms, models, tasks, pagination, timeline, search
+from .. import cache as support_cache
 from django.contrib.auth.decorators import permission_required, login_required
+from django.contrib.admin.views.decorators import staff_member_required
 
 
 @login_required
 @permission_required('support.view_ticket', raise_exception=True)
 def open_tickets(request):
-    newest_message = models.TicketMessage.objects.filter(ticket=OuterRef('pk')) \
-        .order_by('-date')
-    tickets = models.Ticket.objects.annotate(newest_message_type=Subquery(newest_message.values('type')[:1]))\
-        .filter(
-            Q(newest_message_type=models.TicketMessage.TYPE_CUSTOMER) |
-            Q(newest_message_type=models.TicketMessage.TYPE_SYSTEM_RESPONSE)
-        ).filter(state=models.Ticket.STATE_OPEN) \
-        .filter(deleted=False)
-    tickets = Paginator(tickets, 10)
-
-    page_number = request.GET.get('page')
-    page_obj = tickets.get_page(page_number)
+    tickets = models.Ticket.objects.filter(state=models.Ticket.STATE_OPEN, deleted=False, awaiting_agent=True) \
+        .select_related('customer', 'assigned_to')
+    tickets = pagination.CursorPaginator(tickets, 10)
+    page_obj = tickets.get_page(request.GET.get('cursor'))
 
     return render(request, "support/admin/tickets.html", {
         "tickets": page_obj,
@@ -31,19 +27,11 @@ def open_tickets(request):
 @login_required
 @permission_required('support.view_ticket', raise_exception=True)
 def answered_tickets(request):
-    newest_message = models.TicketMessage.objects.filter(ticket=OuterRef('pk'))\
-        .order_by('-date')
-    tickets = models.Ticket.objects.annotate(newest_message_type=Subquery(newest_message.values('type')[:1]))\
-        .filter(~Q(
-            Q(newest_message_type=models.TicketMessage.TYPE_CUSTOMER) |
-            Q(newest_message_type=models.TicketMessage.TYPE_SYSTEM_RESPONSE)
-        )).filter(state=models.Ticket.STATE_OPEN) \
-        .filter(deleted=False)
+    tickets = models.Ticket.objects.filter(state=models.Ticket.STATE_OPEN, deleted=False, awaiting_agent=False) \
+        .select_related('customer', 'assigned_to')
 
-    tickets = Paginator(tickets, 10)
-
-    page_number = request.GET.get('page')
-    page_obj = tickets.get_page(page_number)
+    tickets = pagination.CursorPaginator(tickets, 10)
+    page_obj = tickets.get_page(request.GET.get('cursor'))
 
     return render(request, "support/admin/tickets.html", {
         "tickets": page_obj,
@@ -55,12 +43,11 @@ def answered_tickets(request):
 @permission_required('support.view_ticket', raise_exception=True)
 def own_tickets(request):
     tickets = models.Ticket.objects.filter(assigned_to=request.user) \
-        .filter(deleted=False)
-
-    tickets = Paginator(tickets, 10)
+        .filter(deleted=False) \
+        .select_related('customer', 'assigned_to')
 
-    page_number = request.GET.get('page')
-    page_obj = tickets.get_page(page_number)
+    tickets = pagination.CursorPaginator(tickets, 10)
+    page_obj = tickets.get_page(request.GET.get('cursor'))
 
     return render(request, "support/admin/tickets.html", {
         "tickets": page_obj,
@@ -72,12 +59,11 @@ def own_tickets(request):
 @permission_required('support.view_ticket', raise_exception=True)
 def closed_tickets(request):
     tickets = models.Ticket.objects.filter(state=models.Ticket.STATE_CLOSED) \
-        .filter(deleted=False)
-
-    tickets = Paginator(tickets, 10)
+        .filter(deleted=False) \
+        .select_related('customer', 'assigned_to')
 
-    page_number = request.GET.get('page')
-    page_obj = tickets.get_page(page_number)
+    tickets = pagination.CursorPaginator(tickets, 10)
+    page_obj = tickets.get_page(request.GET.get('cursor'))
 
     return render(request, "support/admin/tickets.html", {
         "tickets": page_obj,
@@ -85,10 +71,39 @@ def closed_tickets(request):
     })
 
 
+@login_required
+@permission_required('support.view_ticket', raise_exception=True)
+def search_tickets(request):
+    results = None
+    search_form = forms.TicketSearchForm(request.GET or None)
+
+    if search_form.is_valid():
+        filters = {
+            "state": search_form.cleaned_data['state'],
+            "priority": search_form.cleaned_data['priority'],
+            "assigned_to": search_form.cleaned_data['assigned_to'],
+        }
+        if search_form.cleaned_data['date_from']:
+            filters["date_from"] = timezone.make_aware(
+                datetime.datetime.combine(search_form.cleaned_data['date_from'], datetime.time.min)
+            )
+        if search_form.cleaned_data['date_to']:
+            filters["date_to"] = timezone.make_aware(
+                datetime.datetime.combine(search_form.cleaned_data['date_to'], datetime.time.max)
+            )
+        results = search.search(search_form.cleaned_data['q'], filters, limit=settings.SEARCH_RESULT_LIMIT)
+
+    return render(request, "support/admin/search.html", {
+        "search_form": search_form,
+        "results": results,
+        "tickets_type": "search",
+    })
+
+
 @login_required
 @permission_required('support.view_ticket', raise_exception=True)
 def view_ticket(request, ticket_id):
-    ticket = get_object_or_404(models.Ticket, id=ticket_id)
+    ticket = get_object_or_404(models.Ticket.objects.select_related('customer__user', 'assigned_to'), id=ticket_id)
 
     ticket_reply_form = forms.TicketReplyForm()
     ticket_note_form = forms.TicketNoteForm()
@@ -118,11 +133,30 @@ def view_ticket(request, ticket_id):
 
     return render(request, "support/admin/ticket.html", {
         "ticket": ticket,
+        "timeline": timeline.load_timeline(ticket, prefetch=False, limit=settings.TIMELINE_INITIAL_MESSAGES),
         "ticket_reply_form": ticket_reply_form,
         "ticket_note_form": ticket_note_form,
     })
 
 
+@login_required
+@permission_required('support.view_ticket', raise_exception=True)
+def ticket_messages(request, ticket_id):
+    ticket = get_object_or_404(models.Ticket, id=ticket_id)
+
+    earlier = timeline.load_earlier(
+        ticket, request.GET.get("before", ""), settings.TIMELINE_PAGE_MESSAGES, prefetch=False
+    )
+    if earlier is None:
+        return HttpResponseBadRequest()
+    messages, cursor = earlier
+
+    return JsonResponse({
+        "html": timeline.render_message_cards(messages, "support/admin/message_card.html"),
+        "before": cursor,
+    })
+
+
 @login_required
 @permission_required('support.change_ticket', raise_exception=True)
 def edit_ticket(request, ticket_id):
@@ -291,3 +325,11 @@ def create_ticket(request):
     return render(request, "support/admin/create_ticket.html", {
         "ticket_create_form": ticket_create_form
     })
+
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse({
+        "pid": os.getpid(),
+        "caches": support_cache.cache_stats(),
+    })
@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.http import HttpResponse, Http404
+from django.utils.crypto import constant_time_compare
+import prometheus_client
+from .. import middleware, metrics as support_metrics
+
+
+@middleware.try_login_exempt
+def metrics(request):
+    if not settings.METRICS_TOKEN:
+        raise Http404()
+
+    if not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {settings.METRICS_TOKEN}"):
+        return HttpResponse(status=401)
+
+    return HttpResponse(
+        prometheus_client.generate_latest(support_metrics.registry()),
+        content_type=prometheus_client.CONTENT_TYPE_LATEST
+    )
@@ -1,14 +1,15 @@
 from django.shortcuts import render, get_object_or_404, redirect
 from django.views.decorators.http import require_POST
-from .. import forms, models, tasks
+from .. import forms, models, tasks, pgp, pagination, timeline
 import requests
 import stripe.identity
 import pgpy
-from django.core.paginator import Paginator
 from django.conf import settings
-from django.db.models import Max
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import SuspiciousOperation
+from django.http import HttpResponseBadRequest, JsonResponse
+
+CUSTOMER_MESSAGE_TYPES = (models.TicketMessage.TYPE_CUSTOMER, models.TicketMessage.TYPE_RESPONSE)
 
 
 def index(request):
@@ -83,15 +84,10 @@ def new_ticket(request):
 
 @login_required
 def tickets(request):
-    user_tickets = models.Ticket.objects.annotate(latest_message=Max('messages__date')) \
-        .order_by('-latest_message') \
-        .filter(customer=request.user.customer) \
-        .distinct()
-
-    tickets = Paginator(user_tickets, 10)
+    user_tickets = models.Ticket.objects.filter(customer=request.user.customer)
 
-    page_number = request.GET.get('page')
-    page_obj = tickets.get_page(page_number)
+    tickets = pagination.CursorPaginator(user_tickets, 10)
+    page_obj = tickets.get_page(request.GET.get('cursor'))
 
     return render(request, "support/tickets.html", {
         "tickets": page_obj
@@ -115,10 +111,34 @@ def ticket(request, ticket_id):
 
     return render(request, "support/ticket.html", {
         "ticket": user_ticket,
+        "timeline": timeline.load_timeline(
+            user_ticket, types=CUSTOMER_MESSAGE_TYPES, prefetch=False, limit=settings.TIMELINE_INITIAL_MESSAGES
+        ),
         "ticket_reply_form": ticket_reply_form
     })
 
 
+@login_required
+def ticket_messages(request, ticket_id):
+    user_ticket = get_object_or_404(models.Ticket, id=ticket_id)
+
+    if user_ticket.customer_id != request.user.customer.id:
+        raise SuspiciousOperation()
+
+    earlier = timeline.load_earlier(
+        user_ticket, request.GET.get("before", ""), settings.TIMELINE_PAGE_MESSAGES,
+        types=CUSTOMER_MESSAGE_TYPES, prefetch=False
+    )
+    if earlier is None:
+        return HttpResponseBadRequest()
+    messages, cursor = earlier
+
+    return JsonResponse({
+        "html": timeline.render_message_cards(messages, "support/message_card.html"),
+        "before": cursor,
+    })
+
+
 @login_required
 def verify_ticket(request, verification_token):
     user_ticket = get_object_or_404(models.Ticket, verification_token=verification_token)
@@ -171,16 +191,17 @@ def new_pgp_key(request):
         form = forms.PGPKeyForm(request.POST)
         if form.is_valid():
             try:
-                key, _ = pgpy.PGPKey.from_blob(form.cleaned_data['key'])
+                fingerprint, key_ids, key = pgp.parse_key(form.cleaned_data['key'])
             except (ValueError, pgpy.errors.PGPError):
                 form.add_error('key', "No valid PGP key found")
             else:
                 models.CustomerPGPKey.objects.update_or_create(
                     customer=request.user.customer,
-                    fingerprint=key.fingerprint,
+                    fingerprint=fingerprint,
                     defaults={
-                        "pgp_key": str(key),
-                        "primary": request.user.customer.pgp_keys.count() == 0,
+                        "pgp_key": key,
+                        "key_ids": key_ids,
+                        "primary": not request.user.customer.has_pgp_keys(),
                     }
                 )
                 return redirect('pgp_keys')
@@ -197,7 +218,8 @@ def new_pgp_key(request):
 def make_pgp_key_primary(request, key_id):
     key = get_object_or_404(models.CustomerPGPKey, id=key_id)
     if request.POST.get("make_pgp_key_primary") == "true" and key.customer == request.user.customer:
-        models.CustomerPGPKey.objects.all().update(primary=False)
+        request.user.customer.pgp_keys.update(primary=False)
+        request.user.customer.invalidate_pgp_key_state()
         key.primary = True
         key.save()
 